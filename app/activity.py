@@ -0,0 +1,202 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from heapq import nlargest
+
+from sanic.log import logger
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert
+
+import config
+from app.db import run_in_db
+from app.metrics import registry
+from app.models import Post, PostActivity
+from app.serializers import to_dict
+from main import app
+
+TRENDING_FIELDS = ('post_id', 'category_id', 'title', 'score', 'views', 'comments')
+
+
+def current_hour() -> int:
+    """Номер текущего часа от начала эпохи UTC (PostActivity.hour)"""
+    return int(time.time() // 3600)
+
+
+def upsert_activity(session, rows):
+    """
+    Прибавляет счётчики rows [{post_id, hour, views, comments}, ...] к строкам post_activity
+    запросами INSERT ... ON CONFLICT DO UPDATE по BULK_INSERT_CHUNK строк.
+    Строки упорядочены по ключу, чтобы воркеры, записывающие одни и те же строки, не блокировали друг друга
+    взаимно. На других СУБД (например, SQLite) каждая строка изменяется отдельным запросом.
+    """
+    table = PostActivity.__table__
+    rows = sorted(rows, key=lambda row: (row['post_id'], row['hour']))
+    if session.bind.dialect.name != 'postgresql':
+        for row in rows:
+            key = (table.c.post_id == row['post_id']) & (table.c.hour == row['hour'])
+            statement = table.update().where(key).values(views=table.c.views + row['views'],
+                                                          comments=table.c.comments + row['comments'])
+            if not session.execute(statement).rowcount:
+                session.execute(table.insert().values(row))
+        return
+
+    for start in range(0, len(rows), config.BULK_INSERT_CHUNK):
+        statement = insert(table).values(rows[start:start + config.BULK_INSERT_CHUNK])
+        session.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.post_id, table.c.hour],
+            set_={'views': table.c.views + statement.excluded.views,
+                  'comments': table.c.comments + statement.excluded.comments}))
+
+
+def decay(hour):
+    """
+    Вес активности каждого часа окна TRENDING_WINDOW: вдвое меньше каждые TRENDING_HALF_LIFE часов.
+    Веса считаются здесь и передаются в запрос, поэтому он не зависит от математических функций СУБД.
+    """
+    weights = {bucket: 0.5 ** ((hour - bucket) / config.TRENDING_HALF_LIFE)
+               for bucket in range(hour - config.TRENDING_WINDOW + 1, hour + 1)}
+    return case(weights, value=PostActivity.hour, else_=0)
+
+
+def rank_posts(session, hour) -> list:
+    """
+    Считает рейтинг постов по активности за TRENDING_WINDOW часов до часа hour и удаляет более старые счётчики.
+    :return лучшие TRENDING_SIZE постов каждой категории [{post_id, category_id, title, score, views, comments}, ...]
+    """
+    since = hour - config.TRENDING_WINDOW
+    session.query(PostActivity).filter(PostActivity.hour <= since).delete(synchronize_session=False)
+
+    activity = PostActivity.views + PostActivity.comments * config.TRENDING_COMMENT_WEIGHT
+    scores = session.query(PostActivity.post_id,
+                           func.sum(activity * decay(hour)).label('score'),
+                           func.sum(PostActivity.views).label('views'),
+                           func.sum(PostActivity.comments).label('comments')) \
+        .filter(PostActivity.hour > since) \
+        .group_by(PostActivity.post_id) \
+        .subquery()
+    # счётчики удалённых постов отбрасываются соединением с posts
+    rank = func.row_number().over(partition_by=Post.category_id, order_by=(scores.c.score.desc(), Post.post_id))
+    ranked = session.query(Post.post_id, Post.category_id, Post.title, scores.c.score, scores.c.views,
+                           scores.c.comments, rank.label('rank')) \
+        .join(scores, scores.c.post_id == Post.post_id) \
+        .subquery()
+    rows = session.query(ranked) \
+        .filter(ranked.c.rank <= config.TRENDING_SIZE) \
+        .order_by(ranked.c.category_id, ranked.c.rank)
+    return [to_dict(row, TRENDING_FIELDS, score=round(float(row.score), 3)) for row in rows]
+
+
+class Activity:
+    """
+    Просмотры и новые комментарии постов, накопленные воркером с последней записи в базу, по (post_id, hour).
+    Раз в ACTIVITY_FLUSH_INTERVAL секунд они записываются одним пакетом (см. upsert_activity), поэтому
+    просмотр поста не добавляет запросов к базе.
+    """
+
+    def __init__(self):
+        self.views = Counter()
+        self.comments = Counter()
+        self.flushed = self.failures = 0
+
+    def add(self, post_id, views=0, comments=0):
+        key = (post_id, current_hour())
+        if views:
+            self.views[key] += views
+        if comments:
+            self.comments[key] += comments
+
+    async def flush(self):
+        views, comments = self.views, self.comments
+        if not views and not comments:
+            return
+        self.views, self.comments = Counter(), Counter()
+        rows = [{'post_id': post_id, 'hour': hour, 'views': views[post_id, hour], 'comments': comments[post_id, hour]}
+                for post_id, hour in views.keys() | comments.keys()]
+        try:
+            await run_in_db(upsert_activity, rows)
+        except Exception:
+            # счётчики возвращаются в буфер и будут записаны следующим пакетом
+            logger.exception(f'Failed to flush activity of {len(rows)} posts')
+            self.views.update(views)
+            self.comments.update(comments)
+            self.failures += 1
+            return
+        self.flushed += len(rows)
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(config.ACTIVITY_FLUSH_INTERVAL)
+            await self.flush()
+
+
+class Trending:
+    """Рейтинг популярных постов воркера, пересчитываемый раз в TRENDING_REFRESH секунд (см. rank_posts)."""
+
+    def __init__(self):
+        self.categories = {}
+        self.posts = []
+        self.refreshed = None
+
+    def get(self, category_id=None) -> list:
+        """Посты категории category_id (или всех категорий) по убыванию рейтинга"""
+        return self.posts if category_id is None else self.categories.get(category_id, [])
+
+    async def refresh(self):
+        try:
+            ranked = await run_in_db(rank_posts, current_hour())
+        except Exception:
+            logger.exception('Failed to refresh trending posts')
+            return
+        categories = {}
+        for post in ranked:
+            categories.setdefault(post['category_id'], []).append(post)
+        # лучшие посты всех категорий входят в лучшие посты своих категорий
+        self.posts = nlargest(config.TRENDING_SIZE, ranked, key=lambda post: post['score'])
+        self.categories = categories
+        self.refreshed = datetime.utcnow()
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(config.TRENDING_REFRESH)
+            await self.refresh()
+
+
+activity = Activity()
+trending = Trending()
+
+
+def activity_metrics() -> list:
+    return ['# TYPE sanicboard_activity_buffered gauge',
+            f'sanicboard_activity_buffered {len(activity.views.keys() | activity.comments.keys())}',
+            '# TYPE sanicboard_activity_flushed_total counter',
+            f'sanicboard_activity_flushed_total {activity.flushed}',
+            '# TYPE sanicboard_activity_flush_failures_total counter',
+            f'sanicboard_activity_flush_failures_total {activity.failures}']
+
+
+registry.collectors.append(activity_metrics)
+
+
+def count_views(handler):
+    """Декоратор обработчика с post_id в пути: успешный ответ, в том числе из кэша и 304, считается просмотром поста"""
+    @wraps(handler)
+    async def wrapper(request, **kwargs):
+        response = await handler(request, **kwargs)
+        if response.status in (200, 304):
+            activity.add(kwargs['post_id'], views=1)
+        return response
+    return wrapper
+
+
+@app.listener('before_server_start')
+async def start_activity(app, loop):
+    await trending.refresh()
+    app.add_task(activity.watch())
+    app.add_task(trending.watch())
+
+
+@app.listener('before_server_stop')
+async def stop_activity(app, loop):
+    await activity.flush()
@@ -0,0 +1,160 @@
+import asyncio
+import math
+import time
+from weakref import WeakValueDictionary
+
+from sanic.response import json
+
+import config
+from app.metrics import registry
+from main import app
+
+# Маршруты с отдельным бюджетом запросов (EXPENSIVE_RATE_LIMIT): полный просмотр или долгая транзакция
+EXPENSIVE_ROUTES = ('/search_category', '/search_post', '/export', '/delete_category/')
+# Маршруты без ограничений: метрики нужны именно во время перегрузки
+EXEMPT_ROUTES = ('/metrics',)
+# Период удаления корзин клиентов, которые давно не обращались, в секундах
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """Корзина токенов: пополняется со скоростью rate токенов в секунду до capacity, запрос забирает один токен."""
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now) -> float:
+        """
+        Забирает токен.
+        :return 0, если токен был, иначе через сколько секунд он появится
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Корзины токенов по клиентам. При rate = 0 ограничение отключено."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets = {}
+
+    def take(self, client, now) -> float:
+        if not self.rate:
+            return 0
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst, now)
+        return bucket.take(now)
+
+    def prune(self, now):
+        # полная корзина ничем не отличается от новой, её можно удалить
+        self.buckets = {client: bucket for client, bucket in self.buckets.items() if not bucket.is_full(now)}
+
+
+class Admission:
+    """
+    Допуск запросов к обработке: бюджеты клиентов и предельное число одновременно обрабатываемых запросов.
+    Запрос, не прошедший проверку, сразу получает ответ с заголовком Retry-After и не занимает соединение с базой.
+    """
+
+    def __init__(self):
+        self.requests = RateLimiter(config.RATE_LIMIT, config.RATE_BURST)
+        self.expensive = RateLimiter(config.EXPENSIVE_RATE_LIMIT, config.EXPENSIVE_RATE_BURST)
+        # запросы, для которых ещё не отправлен ответ, по id(request). Для прерванного по таймауту запроса
+        # response middleware не выполняется, такой запрос удаляется из словаря вместе с самим объектом запроса
+        self.in_flight = WeakValueDictionary()
+        self.results = {'admitted': 0, 'rate': 0, 'expensive': 0, 'overload': 0}
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            now = time.monotonic()
+            self.requests.prune(now)
+            self.expensive.prune(now)
+
+    def metrics(self) -> list:
+        lines = ['# TYPE sanicboard_in_flight_requests gauge',
+                 f'sanicboard_in_flight_requests {len(self.in_flight)}',
+                 '# TYPE sanicboard_rate_limited_clients gauge',
+                 f'sanicboard_rate_limited_clients {len(self.requests.buckets)}',
+                 '# TYPE sanicboard_admission_total counter']
+        lines.extend(f'sanicboard_admission_total{{result="{result}"}} {count}'
+                     for result, count in self.results.items())
+        return lines
+
+
+admission = Admission()
+registry.collectors.append(admission.metrics)
+
+
+def client_address(request) -> str:
+    """
+    Адрес клиента, по которому выбирается корзина токенов.
+    Значение X-Forwarded-For задаёт клиент, поэтому заголовок учитывается только за PROXIES_COUNT доверенными
+    прокси: каждый из них дописывает в конец адрес, с которого к нему пришёл запрос, и адрес клиента - это
+    PROXIES_COUNT-й адрес с конца. Иначе используется адрес соединения.
+    """
+    if config.PROXIES_COUNT > 0:
+        forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')
+                     if address.strip()]
+        if len(forwarded) >= config.PROXIES_COUNT:
+            return forwarded[-config.PROXIES_COUNT]
+    return request.ip
+
+
+def is_expensive(request) -> bool:
+    if request.path.startswith(EXPENSIVE_ROUTES):
+        return True
+    offset = request.args.get('offset')
+    return bool(config.DEEP_OFFSET and offset and offset.isdigit() and int(offset) > config.DEEP_OFFSET)
+
+
+def reject(status, reason, retry_after, error):
+    admission.results[reason] += 1
+    return json(status=status, body={'Error': error}, headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+@app.listener('before_server_start')
+async def start_admission(app, loop):
+    app.add_task(admission.watch())
+
+
+@app.middleware('request')
+async def admit(request):
+    if request.path in EXEMPT_ROUTES:
+        return
+    if config.MAX_IN_FLIGHT and len(admission.in_flight) >= config.MAX_IN_FLIGHT:
+        return reject(503, 'overload', 1, 'Server is overloaded, retry later.')
+
+    client, now = client_address(request), time.monotonic()
+    wait = admission.requests.take(client, now)
+    if wait:
+        return reject(429, 'rate', wait, 'Too many requests.')
+    if is_expensive(request):
+        wait = admission.expensive.take(client, now)
+        if wait:
+            return reject(429, 'expensive', wait, 'Too many expensive requests (search, export, deep pages).')
+
+    admission.in_flight[id(request)] = request
+    admission.results['admitted'] += 1
+
+
+@app.middleware('response')
+async def release(request, response):
+    admission.in_flight.pop(id(request), None)
@@ -0,0 +1,102 @@
+import json
+
+import config
+from app.models import Comment
+
+
+def parse_batch(request) -> list:
+    """
+    Разбирает тело запроса пакетного создания: JSON-массив объектов
+    или NDJSON (Content-Type: application/x-ndjson) - по одному JSON-объекту в строке.
+    :raise ValueError - тело не разбирается, пусто или содержит больше BULK_MAX_ITEMS элементов
+    """
+    if request.content_type.startswith('application/x-ndjson'):
+        items = [json.loads(line) for line in request.body.decode().splitlines() if line.strip()]
+    else:
+        items = json.loads(request.body or b'null')
+
+    if not isinstance(items, list) or not items:
+        raise ValueError('Body must be a non-empty JSON array or NDJSON.')
+    if len(items) > config.BULK_MAX_ITEMS:
+        raise ValueError(f'No more than {config.BULK_MAX_ITEMS} items are allowed per request.')
+    return items
+
+
+def _item_error(item, fields, references, optional):
+    if not isinstance(item, dict):
+        return 'Item must be a JSON object.'
+    for field in fields:
+        if not isinstance(item.get(field), str) or not item[field]:
+            return f'Parameter "{field}" has not been filled.'
+    # bool - подкласс int, но true/false из JSON идентификатором не считаются
+    for field in [field for field, _, _ in references]:
+        if type(item.get(field)) is not int:
+            return f'Parameter "{field}" must be an integer.'
+    for field in optional:
+        if item.get(field) is not None and type(item[field]) is not int:
+            return f'Parameter "{field}" must be an integer.'
+    return None
+
+
+def insert_many(session, model, rows: list) -> list:
+    """
+    Вставляет строки многострочными INSERT ... VALUES ... RETURNING по BULK_INSERT_CHUNK строк
+    и возвращает их первичные ключи в порядке rows.
+    На СУБД без RETURNING (например, SQLite) строки вставляются по одной.
+    """
+    table = model.__table__
+    pk = table.primary_key.columns.values()[0]
+    if session.bind.dialect.name != 'postgresql':
+        return [session.execute(table.insert().values(row)).inserted_primary_key[0] for row in rows]
+
+    ids = []
+    for start in range(0, len(rows), config.BULK_INSERT_CHUNK):
+        chunk = rows[start:start + config.BULK_INSERT_CHUNK]
+        ids.extend(row_id for row_id, in session.execute(table.insert().values(chunk).returning(pk)))
+    return ids
+
+
+def check_parent_comments(session, items, results, valid):
+    """Проверка для bulk_create: родительский комментарий должен существовать и относиться к тому же посту."""
+    wanted = {items[index].get('parent_comment_id') for index in valid} - {None}
+    if not wanted:
+        return
+    parents = dict(session.query(Comment.comment_id, Comment.post_id).filter(Comment.comment_id.in_(wanted)))
+    for index in valid:
+        parent_comment_id = items[index].get('parent_comment_id')
+        if parent_comment_id is not None and parents.get(parent_comment_id) != items[index]['post_id']:
+            results[index]['error'] = f'No comment {parent_comment_id} in post {items[index]["post_id"]}.'
+
+
+def bulk_create(session, model, items, fields, references=(), optional=(), check=None) -> list:
+    """
+    Создаёт записи из пакета items.
+    Ссылки на родительские записи проверяются одним запросом на каждую ссылку,
+    ошибочные элементы пропускаются, остальные вставляются через insert_many.
+    :arg fields - обязательные текстовые поля, например ('title', 'body')
+    :arg references - обязательные ссылки на родителей: [(поле, первичный ключ родителя, имя родителя)]
+    :arg optional - необязательные целочисленные поля, например ('parent_comment_id',)
+    :arg check - дополнительная проверка check(session, items, results, valid), записывающая ошибки в results
+    :return результаты в порядке items: {<первичный ключ>: id} или {'error': описание ошибки}
+    """
+    results = [{'error': _item_error(item, fields, references, optional)} for item in items]
+    valid = [index for index, result in enumerate(results) if not result['error']]
+
+    for field, column, name in references:
+        wanted = {items[index][field] for index in valid}
+        existing = {value for value, in session.query(column).filter(column.in_(wanted))} if wanted else set()
+        for index in valid:
+            if items[index][field] not in existing:
+                results[index]['error'] = f'No {name} {items[index][field]} in database.'
+        valid = [index for index in valid if not results[index]['error']]
+
+    if check:
+        check(session, items, results, valid)
+        valid = [index for index in valid if not results[index]['error']]
+
+    columns = list(fields) + [field for field, _, _ in references] + list(optional)
+    ids = insert_many(session, model, [{column: items[index].get(column) for column in columns} for index in valid])
+    pk = model.__table__.primary_key.columns.values()[0].name
+    for index, row_id in zip(valid, ids):
+        results[index] = {pk: row_id}
+    return results
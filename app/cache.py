@@ -0,0 +1,251 @@
+import pickle
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from sanic.response import HTTPResponse
+
+import config
+from app.conditional import is_not_modified, not_modified
+from app.serializers import media_type
+from main import app
+
+
+class LRUCache:
+    """
+    Кэш в памяти процесса с ограничением размера (вытесняются давно не использованные записи)
+    и временем жизни записей.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Значение без учёта в статистике и без изменения порядка вытеснения"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {'size': len(self), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class LocalBackend:
+    """
+    Общее хранилище в памяти процесса с интерфейсом RedisBackend для тестов:
+    несколько ResponseCache с одним LocalBackend ведут себя как воркеры с общим Redis.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    async def get(self, key):
+        value = self._values.get(key)
+        if value is None or value[0] < time.monotonic():
+            return None
+        return value[1]
+
+    async def set(self, key, value, ttl):
+        self._values[key] = (time.monotonic() + ttl, value)
+
+    async def get_many(self, keys) -> list:
+        return [await self.get(key) for key in keys]
+
+    async def incr(self, key):
+        current = await self.get(key) or 0
+        self._values[key] = (float('inf'), current + 1)
+
+
+class RedisBackend:
+    """Общее для всех воркеров хранилище кэша в Redis (требуется пакет aioredis)."""
+
+    def __init__(self, redis):
+        self._redis = redis
+
+    @classmethod
+    async def connect(cls, uri):
+        import aioredis
+        return cls(await aioredis.create_redis_pool(uri))
+
+    async def get(self, key):
+        value = await self._redis.get(key)
+        return value and pickle.loads(value)
+
+    async def set(self, key, value, ttl):
+        await self._redis.set(key, pickle.dumps(value), expire=int(ttl))
+
+    async def get_many(self, keys) -> list:
+        return [int(value) if value else None for value in await self._redis.mget(*keys)]
+
+    async def incr(self, key):
+        await self._redis.incr(key)
+
+
+class ResponseCache:
+    """
+    Кэш ответов GET-обработчиков.
+
+    Ответ сначала ищется в локальном LRUCache, затем в общем хранилище (если оно подключено).
+    Каждая запись помечена тегами ресурсов, из которых собран ответ ('categories', 'posts:10',
+    'post:15'). У тега есть номер версии; запись с устаревшей версией хотя бы одного тега
+    считается отсутствующей. Обработчики изменения данных вызывают invalidate() с тегами
+    затронутых ресурсов - это увеличивает версии тегов и делает недействительными ровно
+    зависящие от них записи. Версии тегов хранятся в общем хранилище, поэтому инвалидация
+    видна всем воркерам; без него - только в памяти воркера, поэтому с несколькими воркерами
+    кэш без общего хранилища не включается (см. CACHE_ENABLED в config.py).
+    """
+
+    def __init__(self, local: LRUCache, shared=None):
+        self.local = local
+        self.shared = shared
+        self.invalidations = self.stale = 0
+        self.invalidated_at = 0.0
+        self._versions = {}
+
+    async def versions(self, tags) -> dict:
+        if self.shared is None:
+            return {tag: self._versions.get(tag, 0) for tag in tags}
+        versions = await self.shared.get_many([f'tag:{tag}' for tag in tags])
+        return {tag: version or 0 for tag, version in zip(tags, versions)}
+
+    async def get(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = await self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is None:
+            return None
+
+        # записи, сохранённые в Redis до появления сжатых вариантов, состоят из пяти элементов
+        status, content_type, headers, body, versions = entry[:5]
+        if await self.versions(list(versions)) != versions:
+            self.local.delete(key)
+            self.stale += 1
+            return None
+        return HTTPResponse(status=status, content_type=content_type, headers=headers, body_bytes=body)
+
+    async def set(self, key, response, versions):
+        # последний элемент - сжатые варианты тела {кодировка: байты}, см. app/compression.py
+        entry = (response.status, response.content_type, dict(response.headers), response.body, versions, {})
+        self.local.set(key, entry)
+        if self.shared is not None:
+            await self.shared.set(key, entry, self.local.ttl)
+
+    def _entry(self, key, body):
+        """Локальная запись key, если её тело - именно body, то есть запись не заменена более новым ответом"""
+        entry = self.local.peek(key)
+        return entry if entry is not None and entry[3] is body and len(entry) > 5 else None
+
+    def compressed(self, key, body, encoding):
+        """Тело записи key, сжатое кодировкой encoding, или None, если его ещё нет"""
+        entry = self._entry(key, body)
+        return entry and entry[5].get(encoding)
+
+    async def add_compressed(self, key, body, encoding, compressed):
+        """Сохраняет сжатое тело вместе с записью key, чтобы следующие ответы из кэша не сжимались заново"""
+        entry = self._entry(key, body)
+        if entry is None:
+            return
+        entry[5][encoding] = compressed
+        if self.shared is not None:
+            await self.shared.set(key, entry, self.local.ttl)
+
+    async def invalidate(self, *tags):
+        self.invalidations += 1
+        self.invalidated_at = time.monotonic()
+        for tag in tags:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+            if self.shared is not None:
+                await self.shared.incr(f'tag:{tag}')
+
+    def stats(self) -> dict:
+        return dict(self.local.stats(), stale=self.stale, invalidations=self.invalidations,
+                    shared=self.shared is not None)
+
+
+response_cache = ResponseCache(LRUCache(config.CACHE_MAX_SIZE, config.CACHE_TTL))
+
+
+@app.listener('before_server_start')
+async def connect_shared_cache(app, loop):
+    if config.CACHE_REDIS_URI:
+        response_cache.shared = await RedisBackend.connect(config.CACHE_REDIS_URI)
+
+
+def cached(*tags):
+    """
+    Декоратор GET-обработчика: успешные ответы (200) кэшируются по пути и строке запроса.
+    Повторный запрос, пока ни один из тегов записи не инвалидирован, обслуживается без обращения к базе.
+    :arg tags - шаблоны тегов, заполняемые параметрами маршрута, например 'post:{post_id}'.
+                Теги, известные только после чтения из базы, обработчик добавляет в request['cache_tags'].
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, **kwargs):
+            if not config.CACHE_ENABLED:
+                return await handler(request, **kwargs)
+
+            key = f'{media_type(request)} {request.path}?{request.query_string}'
+            response = await response_cache.get(key)
+            if response is not None:
+                request['cache_key'] = key
+                # закэшированный ответ актуален, поэтому его ETag/Last-Modified можно сравнить без запроса к базе
+                if is_not_modified(request, response.headers):
+                    return not_modified(response.headers)
+                return response
+
+            # версии тегов фиксируются до чтения из базы, чтобы изменение данных во время
+            # выполнения обработчика не оставило в кэше устаревший ответ
+            request['cache_tags'] = [tag.format(**kwargs) for tag in tags]
+            versions = await response_cache.versions(request['cache_tags'])
+            response = await handler(request, **kwargs)
+            # реплика могла ещё не получить только что сделанные изменения - такой ответ не кэшируется
+            lagging = request.get('db_replica') and \
+                time.monotonic() - response_cache.invalidated_at < config.REPLICA_MAX_LAG
+            if response.status == 200 and not lagging:
+                versions.update(await response_cache.versions(
+                    [tag for tag in request['cache_tags'] if tag not in versions]))
+                await response_cache.set(key, response, versions)
+                request['cache_key'] = key
+            return response
+        return wrapper
+    return decorator
+
+
+def add_cache_tags(request, *tags):
+    """Добавляет к записи кэша текущего запроса теги, которые стали известны только после чтения из базы."""
+    request.setdefault('cache_tags', []).extend(tags)
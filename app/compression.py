@@ -0,0 +1,124 @@
+import asyncio
+import gzip
+
+from sanic.response import HTTPResponse
+
+import config
+from app.cache import response_cache
+from app.metrics import registry
+from main import app
+
+# brotli и zstd сжимают JSON лучше gzip и используются, если установлены пакеты brotli и zstandard
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Функции сжатия в порядке предпочтения сервера. Уровни выбраны для ответов, сжимаемых на лету:
+# максимальные уровни заметно медленнее при небольшом выигрыше в размере
+COMPRESSORS = {}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=5)
+if zstandard is not None:
+    # ZstdCompressor нельзя использовать из нескольких потоков одновременно
+    COMPRESSORS['zstd'] = lambda body: zstandard.ZstdCompressor(level=3).compress(body)
+COMPRESSORS['gzip'] = lambda body: gzip.compress(body, compresslevel=6)
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/msgpack', 'text/')
+
+
+def negotiate(accept_encoding):
+    """
+    Выбирает кодировку по заголовку Accept-Encoding (например, 'gzip;q=0.8, br') с учётом q-значений;
+    при равных q - в порядке COMPRESSORS.
+    :return 'br', 'zstd', 'gzip' или None, если клиент не принимает ни одной доступной кодировки
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        params = params.replace(' ', '')
+        try:
+            accepted[name.strip().lower()] = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            continue
+    wildcard = accepted.get('*', 0)
+
+    best, best_q = None, 0
+    for encoding in COMPRESSORS:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionStats:
+    def __init__(self):
+        self.responses = {}  # {(кодировка, 'compressed' или 'cached'): количество ответов}
+        self.bytes_in = self.bytes_out = 0
+
+    def record(self, encoding, source, size, compressed_size):
+        self.responses[encoding, source] = self.responses.get((encoding, source), 0) + 1
+        self.bytes_in += size
+        self.bytes_out += compressed_size
+
+    def metrics(self) -> list:
+        lines = ['# TYPE sanicboard_compressed_responses_total counter']
+        lines.extend(f'sanicboard_compressed_responses_total{{encoding="{encoding}",source="{source}"}} {count}'
+                     for (encoding, source), count in sorted(self.responses.items()))
+        lines.extend(['# TYPE sanicboard_compression_bytes_total counter',
+                      f'sanicboard_compression_bytes_total{{stage="in"}} {self.bytes_in}',
+                      f'sanicboard_compression_bytes_total{{stage="out"}} {self.bytes_out}'])
+        return lines
+
+
+compression_stats = CompressionStats()
+registry.collectors.append(compression_stats.metrics)
+
+
+async def compress(body, encoding) -> bytes:
+    """Сжимает body; большие тела сжимаются в пуле потоков по умолчанию, а не в event loop"""
+    if len(body) < config.COMPRESSION_EXECUTOR_SIZE:
+        return COMPRESSORS[encoding](body)
+    return await asyncio.get_event_loop().run_in_executor(None, COMPRESSORS[encoding], body)
+
+
+@app.middleware('response')
+async def compress_response(request, response):
+    # потоковые ответы (/export, /subscribe) отправляются частями и не сжимаются
+    if not config.COMPRESSION_ENABLED or not isinstance(response, HTTPResponse) or response.status != 200 \
+            or 'Content-Encoding' in response.headers or not response.content_type.startswith(COMPRESSIBLE_TYPES):
+        return
+    body = response.body
+    if len(body) < config.COMPRESSION_MIN_SIZE:
+        return
+
+    vary = response.headers.get('Vary')
+    response.headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return
+
+    # ответ из кэша (или только что в него записанный) сжимается один раз, далее берётся сжатый вариант записи
+    key = request.get('cache_key')
+    compressed = key and response_cache.compressed(key, body, encoding)
+    if compressed:
+        compression_stats.record(encoding, 'cached', len(body), len(compressed))
+    else:
+        compressed = await compress(body, encoding)
+        compression_stats.record(encoding, 'compressed', len(body), len(compressed))
+        if key:
+            await response_cache.add_compressed(key, body, encoding, compressed)
+
+    response.body = compressed
+    response.headers['Content-Encoding'] = encoding
+    # сжатое представление отличается побайтно, поэтому ETag становится слабым (как в nginx)
+    etag = response.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.headers['ETag'] = f'W/{etag}'
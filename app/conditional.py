@@ -0,0 +1,123 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import wraps
+from hashlib import sha1
+
+from sanic.response import HTTPResponse
+from sqlalchemy import func
+
+from app.db import run_in_db
+from app.models import Post, Comment
+from app.serializers import media_type
+
+
+def _state(session, *parts):
+    """
+    Одним запросом возвращает время последнего изменения и количество строк для каждой пары
+    (модель, условие). Строки не загружаются, считаются только агрегаты.
+    Количество строк нужно, чтобы заметить удаление: оно не меняет времени изменения оставшихся строк.
+    :arg parts - первая пара отбирает сам ресурс, остальные - его дочерние записи
+    :return None, если ресурса нет
+    """
+    columns = []
+    for model, criterion in parts:
+        changed = func.coalesce(model.last_edit, model.created)
+        columns.append(session.query(func.max(changed)).filter(criterion).as_scalar())
+        columns.append(session.query(func.count()).select_from(model).filter(criterion).as_scalar())
+    state = tuple(session.query(*columns).one())
+    return state if state[1] else None
+
+
+def post_state(session, args, post_id):
+    return _state(session, (Post, Post.post_id == post_id), (Comment, Comment.post_id == post_id))
+
+
+def comment_state(session, args, comment_id):
+    return _state(session, (Comment, Comment.comment_id == comment_id),
+                  (Comment, Comment.parent_comment_id == comment_id))
+
+
+def comment_thread_state(session, args, comment_id):
+    post = session.query(Comment.post_id).filter_by(comment_id=comment_id)
+    return _state(session, (Comment, Comment.comment_id == comment_id), (Comment, Comment.post_id.in_(post)))
+
+
+def validators(request, state) -> dict:
+    """
+    Заголовки ETag и Last-Modified для ответа на запрос.
+    ETag зависит от пути, строки запроса, формата ответа и состояния ресурса,
+    Last-Modified - самое позднее время изменения.
+    """
+    etag = sha1(repr((request.path, request.query_string, media_type(request), state)).encode()).hexdigest()
+    headers = {'ETag': f'"{etag}"'}
+    changed = [value for value in state if isinstance(value, datetime)]
+    if changed:
+        headers['Last-Modified'] = format_datetime(max(changed).replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+
+def is_not_modified(request, headers) -> bool:
+    """
+    Проверяет If-None-Match/If-Modified-Since запроса по заголовкам ETag/Last-Modified ответа.
+    If-Modified-Since учитывается только без If-None-Match: время изменения не отражает удаление строк.
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        etags = [etag.strip().replace('W/', '', 1) for etag in if_none_match.split(',')]
+        # '*' означает "любая версия ресурса" и подходит, только если ресурс существует (у ответа есть ETag)
+        return 'ETag' in headers and (headers['ETag'] in etags or '*' in etags)
+
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is None or 'Last-Modified' not in headers:
+        return False
+    try:
+        return parsedate_to_datetime(headers['Last-Modified']) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified(headers) -> HTTPResponse:
+    return HTTPResponse(status=304, headers={name: value for name, value in headers.items()
+                                             if name in ('ETag', 'Last-Modified')})
+
+
+def conditional(state=None):
+    """
+    Декоратор GET-обработчика с поддержкой условных запросов.
+    Перед вызовом обработчика выполняется дешёвый запрос state(session, параметры запроса, **параметры маршрута);
+    если ресурс не изменился с версии клиента, возвращается 304 без выборки и сериализации данных.
+    Без state (списки, где состояние страницы стоит столько же, сколько её выборка) ETag строится по телу ответа
+    обработчика: 304 экономит передачу и разбор ответа, а база опрашивается один раз.
+    Успешные ответы получают заголовки ETag и Last-Modified (Last-Modified - только при заданном state).
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, **kwargs):
+            if state is None:
+                response = await handler(request, **kwargs)
+                if response.status != 200:
+                    return response
+                headers = validators(request, (response.body,))
+                if is_not_modified(request, headers):
+                    return not_modified(headers)
+                response.headers.update(headers)
+                return response
+
+            try:
+                current = await run_in_db(lambda session: state(session, request.args, **kwargs))
+            except ValueError:
+                # неверные параметры запроса: обработчик ответит 400
+                return await handler(request, **kwargs)
+            if current is None:
+                # ресурса нет: обработчик ответит ошибкой, If-None-Match: * к нему не относится
+                return await handler(request, **kwargs)
+            headers = validators(request, current)
+            if is_not_modified(request, headers):
+                return not_modified(headers)
+
+            response = await handler(request, **kwargs)
+            if response.status == 200:
+                response.headers.update(headers)
+            return response
+        return wrapper
+    return decorator
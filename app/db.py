@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+
+from sqlalchemy import and_, func, or_, select
+
+import config
+from app.metrics import registry
+from main import make_session
+
+
+# Синхронные вызовы SQLAlchemy/psycopg2 выполняются в ограниченном пуле потоков,
+# чтобы медленный запрос не останавливал event loop воркера.
+db_executor = ThreadPoolExecutor(max_workers=config.DB_CONCURRENCY, thread_name_prefix='db')
+
+# Реплика, с которой читает текущий запрос (выбирается в app/replicas.py); None - основной сервер
+read_engine = contextvars.ContextVar('read_engine', default=None)
+
+
+def new_session():
+    """Сессия на реплике, выбранной для текущего запроса, или на основном сервере"""
+    engine = read_engine.get()
+    return make_session(bind=engine) if engine is not None else make_session()
+
+
+@contextmanager
+def session_scope():
+    """Provide a transactional scope around a series of operations."""
+    session = new_session()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _run_in_session(work, *args):
+    with session_scope() as session:
+        started = time.perf_counter()
+        session.connection()
+        registry.pool_wait.observe(time.perf_counter() - started)
+        return work(session, *args)
+
+
+async def run_in_db(work, *args):
+    """
+    Выполняет work(session, *args) внутри session_scope в пуле потоков db_executor
+    и возвращает её результат, не блокируя event loop.
+    Контекст запроса копируется в поток, чтобы SQL-запросы попали в его метрики (app/metrics.py).
+    """
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, partial(context.run, _run_in_session, work, *args))
+
+
+def count_by(session, column, ids) -> dict:
+    """
+    Считает дочерние записи для набора родителей одним сгруппированным запросом
+    вместо отдельного count() на каждую строку выдачи.
+    :arg column - внешний ключ, по которому группируются дочерние записи (например, Post.category_id)
+    :arg ids - идентификаторы родительских записей
+    :return {id: количество}; для родителей без дочерних записей ключ отсутствует
+    """
+    if not ids:
+        return {}
+    return dict(session.query(column, func.count()).filter(column.in_(ids)).group_by(column))
+
+
+def update_returning(session, model, key, values: dict):
+    """
+    Изменяет строку одним запросом UPDATE ... RETURNING и возвращает её новое состояние.
+    Строка изменяется, только если хотя бы одно из значений values отличается от текущего;
+    last_edit проставляется автоматически.
+    На СУБД без RETURNING (например, SQLite) строка перечитывается отдельным запросом.
+    :arg key - условие отбора строки по первичному ключу, например Post.post_id == 10
+    :return изменённая строка или None, если строки нет или менять нечего
+    """
+    table = model.__table__
+    changed = or_(*[getattr(model, name).is_distinct_from(value) for name, value in values.items()])
+    statement = table.update().where(and_(key, changed)).values(last_edit=datetime.utcnow(), **values)
+
+    if session.bind.dialect.name == 'postgresql':
+        return session.execute(statement.returning(*table.columns)).first()
+    if not session.execute(statement).rowcount:
+        return None
+    return session.execute(select(table.columns).where(key)).first()
+
+
+class Slots:
+    """Ограниченное количество мест, например одновременных выгрузок воркера"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.taken = 0
+
+    def acquire(self) -> bool:
+        """Занимает место; False, если свободных мест нет"""
+        if self.taken >= self.limit:
+            return False
+        self.taken += 1
+        return True
+
+    def release(self):
+        self.taken -= 1
+
+
+# Одновременные выгрузки stream_in_db: место занимает обработчик до начала ответа, чтобы сверх предела ответить 503
+stream_slots = Slots(config.EXPORT_CONCURRENCY)
+
+
+async def stream_in_db(statements, batch_size=config.EXPORT_BATCH_SIZE):
+    """
+    Асинхронный генератор, выдающий строки запросов statements [(метка, запрос), ...] порциями (метка, строки)
+    по batch_size строк. Используется серверный курсор (stream_results), поэтому в памяти находится
+    не больше одной порции.
+    Все запросы выполняются в одной сессии в отдельном потоке выгрузки: драйверы (например, sqlite3) не
+    позволяют использовать курсор из другого потока, а медленный клиент не должен занимать потоки db_executor.
+    Соединение выгрузки берётся сверх соединений db_executor (см. create_db_engine в main.py).
+    """
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+
+    def run(work, *args):
+        return loop.run_in_executor(executor, partial(context.run, work, *args))
+
+    session = await run(new_session)
+    try:
+        for label, statement in statements:
+            result = await run(session.execute, statement.execution_options(stream_results=True))
+            while True:
+                rows = await run(result.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield label, rows
+    finally:
+        await run(session.close)
+        executor.shutdown(wait=False)
@@ -0,0 +1,85 @@
+from sanic.log import logger
+
+import config
+from app.cache import response_cache
+from app.db import run_in_db
+from app.models import Category, Post, Comment
+from app.threads import thread_cte
+
+
+def category_tags(session, category_id) -> list:
+    """
+    Теги кэша, которые становятся недействительными при удалении категории:
+    список её постов и каждый её пост (в записях постов и комментариев тега категории нет).
+    """
+    posts = session.query(Post.post_id).filter_by(category_id=category_id)
+    return [f'posts:{category_id}'] + [f'post:{post_id}' for post_id, in posts]
+
+
+def delete_category_tree(session, category_id) -> int:
+    """
+    Удаляет категорию вместе с постами и всеми комментариями к ним тремя запросами.
+    :return количество удалённых категорий (0, если категории нет)
+    """
+    posts = session.query(Post.post_id).filter_by(category_id=category_id)
+    session.query(Comment).filter(Comment.post_id.in_(posts)).delete(synchronize_session=False)
+    posts.delete(synchronize_session=False)
+    return session.query(Category).filter_by(category_id=category_id).delete(synchronize_session=False)
+
+
+def delete_post_tree(session, post_id):
+    """
+    Удаляет пост вместе со всеми комментариями к нему.
+    :return строка с category_id удалённого поста или None, если поста нет
+    """
+    post = session.query(Post.category_id).filter_by(post_id=post_id).first()
+    if not post:
+        return None
+    session.query(Comment).filter_by(post_id=post_id).delete(synchronize_session=False)
+    session.query(Post).filter_by(post_id=post_id).delete(synchronize_session=False)
+    return post
+
+
+def delete_comment_tree(session, comment_id):
+    """
+    Удаляет комментарий вместе со всеми вложенными комментариями любой глубины.
+    :return строка с post_id и category_id удалённого комментария или None, если комментария нет
+    """
+    comment = session.query(Comment.post_id, Post.category_id) \
+        .outerjoin(Post, Post.post_id == Comment.post_id) \
+        .filter(Comment.comment_id == comment_id) \
+        .first()
+    if not comment:
+        return None
+    thread = thread_cte(session, Comment.comment_id == comment_id)
+    session.query(Comment).filter(Comment.comment_id.in_(session.query(thread.c.comment_id))) \
+        .delete(synchronize_session=False)
+    return comment
+
+
+def _delete_comments_chunk(session, category_id, chunk_size) -> int:
+    posts = session.query(Post.post_id).filter_by(category_id=category_id)
+    chunk = session.query(Comment.comment_id).filter(Comment.post_id.in_(posts)).limit(chunk_size)
+    return session.query(Comment).filter(Comment.comment_id.in_(chunk)).delete(synchronize_session=False)
+
+
+def _delete_posts_chunk(session, category_id, chunk_size) -> int:
+    chunk = session.query(Post.post_id).filter_by(category_id=category_id).limit(chunk_size)
+    return session.query(Post).filter(Post.post_id.in_(chunk)).delete(synchronize_session=False)
+
+
+async def purge_category(category_id, chunk_size=config.DELETE_CHUNK_SIZE):
+    """
+    Фоновое удаление большой категории: комментарии и посты удаляются порциями по chunk_size строк,
+    каждая порция - в отдельной короткой транзакции, поэтому блокировки не держатся долго.
+    Оставшиеся записи и сама категория удаляются последним запросом delete_category_tree.
+    """
+    try:
+        tags = await run_in_db(category_tags, category_id)
+        for delete_chunk in (_delete_comments_chunk, _delete_posts_chunk):
+            while await run_in_db(delete_chunk, category_id, chunk_size):
+                pass
+        await run_in_db(delete_category_tree, category_id)
+        await response_cache.invalidate('categories', f'category:{category_id}', *tags)
+    except Exception:
+        logger.exception(f'Background deletion of category {category_id} has failed')
@@ -0,0 +1,219 @@
+import asyncio
+import json
+
+from sanic.log import logger
+from sqlalchemy import func, select
+
+import config
+from app.db import run_in_db
+from app.metrics import registry
+from app.serializers import dumps
+from main import app, make_session
+
+# Канал Postgres LISTEN/NOTIFY, через который воркеры пересылают друг другу события (EVENTS_NOTIFY)
+CHANNEL = 'sanicboard_events'
+# Предельный размер сообщения NOTIFY в Postgres - 8000 байт
+NOTIFY_LIMIT = 7900
+# Количество событий, отправляемых одним запросом SELECT pg_notify(...), pg_notify(...), ...
+NOTIFY_BATCH = 100
+
+
+class Subscription:
+    def __init__(self, topics):
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize=config.EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+
+class Hub:
+    """
+    Рассылка событий подписчикам воркера. Событие кодируется один раз и одним и тем же сообщением
+    кладётся в очереди всех подписчиков его тем (например, 'post:10', 'category:3').
+    Подписчик, не успевающий читать события, отключается: клиент переподключается и перечитывает данные.
+    """
+
+    def __init__(self):
+        self.topics = {}
+        self.connection = None  # соединение LISTEN при EVENTS_NOTIFY
+        self.fileno = None
+        self.reconnecting = None  # задача восстановления соединения LISTEN
+        self.dispatched = self.delivered = self.dropped = 0
+
+    def subscribe(self, topics) -> Subscription:
+        subscription = Subscription(topics)
+        for topic in topics:
+            self.topics.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for topic in subscription.topics:
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.topics[topic]
+
+    def disconnect_all(self):
+        """Отключает всех подписчиков так же, как при переполнении очереди, например после потери событий"""
+        for subscribers in self.topics.values():
+            for subscription in subscribers:
+                subscription.overflowed = True
+
+    def dispatch(self, topics, name, data):
+        """Доставляет событие name с данными data подписчикам тем topics в этом воркере"""
+        subscribers = set()
+        for topic in topics:
+            subscribers.update(self.topics.get(topic, ()))
+        self.dispatched += 1
+        if not subscribers:
+            return
+        message = b'event: ' + name.encode() + b'\ndata: ' + dumps(data) + b'\n\n'
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+                self.dropped += 1
+
+    def metrics(self) -> list:
+        subscriptions = {subscription for subscribers in self.topics.values() for subscription in subscribers}
+        return ['# TYPE sanicboard_event_subscriptions gauge',
+                f'sanicboard_event_subscriptions {len(subscriptions)}',
+                '# TYPE sanicboard_events_total counter',
+                f'sanicboard_events_total{{state="dispatched"}} {self.dispatched}',
+                f'sanicboard_events_total{{state="delivered"}} {self.delivered}',
+                f'sanicboard_events_total{{state="dropped"}} {self.dropped}']
+
+
+hub = Hub()
+registry.collectors.append(hub.metrics)
+
+
+def event_stream(request, topics):
+    """
+    Функция для sanic.response.stream, отправляющая клиенту события тем topics в формате Server-Sent Events.
+    Пока событий нет, раз в EVENTS_HEARTBEAT секунд отправляется комментарий, по которому
+    обнаруживается отключение клиента.
+    """
+    async def write(response):
+        subscription = hub.subscribe(topics)
+        try:
+            await response.write(b': subscribed\n\n')
+            while not subscription.overflowed:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), config.EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if request.transport.is_closing():
+                        return
+                    message = b': ping\n\n'
+                await response.write(message)
+            await response.write(b'event: overflow\ndata: {}\n\n')
+        finally:
+            hub.unsubscribe(subscription)
+    return write
+
+
+async def publish(*events):
+    """
+    Публикует события (темы, имя события, данные), например (['post:10', 'category:3'], 'comment_added', {...}).
+    При EVENTS_NOTIFY события отправляются через Postgres NOTIFY одним запросом и доставляются подписчикам
+    всех воркеров, иначе - только подписчикам текущего воркера.
+    """
+    if not config.EVENTS_NOTIFY:
+        for topics, name, data in events:
+            hub.dispatch(topics, name, data)
+        return
+
+    payloads = []
+    for topics, name, data in events:
+        payload = dumps({'topics': list(topics), 'name': name, 'data': data})
+        if len(payload) > NOTIFY_LIMIT:
+            # большие записи не помещаются в NOTIFY: подписчики получают только идентификаторы
+            data = {key: value for key, value in data.items() if key.endswith('_id')}
+            payload = dumps({'topics': list(topics), 'name': name, 'data': data})
+        payloads.append(payload.decode())
+
+    def notify(session):
+        for start in range(0, len(payloads), NOTIFY_BATCH):
+            session.execute(select([func.pg_notify(CHANNEL, payload)
+                                    for payload in payloads[start:start + NOTIFY_BATCH]]))
+
+    await run_in_db(notify)
+
+
+def _listen(psycopg2):
+    """Открывает соединение LISTEN, изъятое из пула: подписка на канал работает, пока соединение открыто"""
+    connection = make_session.kw['bind'].raw_connection()
+    connection.detach()
+    try:
+        connection.connection.set_isolation_level(0)
+        connection.connection.cursor().execute(f'LISTEN {CHANNEL}')
+    except psycopg2.Error:
+        connection.close()
+        raise
+    return connection
+
+
+def _stop_listening(loop):
+    if hub.connection is None:
+        return
+    loop.remove_reader(hub.fileno)
+    try:
+        hub.connection.close()
+    except Exception:
+        pass
+    hub.connection = None
+
+
+@app.listener('before_server_start')
+async def listen_events(app, loop):
+    if not config.EVENTS_NOTIFY:
+        return
+    import psycopg2
+
+    def receive():
+        connection = hub.connection.connection
+        try:
+            connection.poll()
+        except psycopg2.Error:
+            logger.exception('Connection for events has been lost, reconnecting')
+            _stop_listening(loop)
+            hub.reconnecting = loop.create_task(reconnect())
+            return
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            try:
+                event = json.loads(notify.payload)
+                hub.dispatch(event['topics'], event['name'], event['data'])
+            except (ValueError, KeyError):
+                logger.exception(f'Invalid event: {notify.payload}')
+
+    def start(connection):
+        hub.connection, hub.fileno = connection, connection.connection.fileno()
+        loop.add_reader(hub.fileno, receive)
+
+    async def reconnect():
+        delay = 1
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                connection = await loop.run_in_executor(None, _listen, psycopg2)
+            except Exception:
+                delay = min(delay * 2, config.EVENTS_RECONNECT_MAX)
+                logger.warning(f'Could not reconnect for events, next attempt in {delay} s', exc_info=True)
+                continue
+            start(connection)
+            hub.reconnecting = None
+            # события, отправленные без соединения, не получены: подписчики переподключаются и перечитывают данные
+            hub.disconnect_all()
+            return
+
+    start(_listen(psycopg2))
+
+
+@app.listener('before_server_stop')
+async def stop_listening_events(app, loop):
+    if hub.reconnecting is not None:
+        hub.reconnecting.cancel()
+    _stop_listening(loop)
@@ -0,0 +1,35 @@
+from sqlalchemy import func, select
+
+from app.models import Category, Post, Comment
+from app.serializers import dumps
+
+
+def export_statements(category_id=None, since=None) -> list:
+    """
+    Запросы выгрузки в порядке категории, посты, комментарии.
+    :arg category_id - выгрузить только эту категорию с её постами и комментариями (optional)
+    :arg since - выгрузить только записи, созданные или изменённые начиная с этого момента (optional)
+    :return [(тип записи, запрос), ...]
+    """
+    statements = []
+    for kind, model, pk in (('category', Category, Category.category_id),
+                            ('post', Post, Post.post_id),
+                            ('comment', Comment, Comment.comment_id)):
+        statement = select([model.__table__]).order_by(pk)
+        if category_id is not None:
+            if model is Category:
+                statement = statement.where(Category.category_id == category_id)
+            elif model is Post:
+                statement = statement.where(Post.category_id == category_id)
+            else:
+                posts = select([Post.post_id]).where(Post.category_id == category_id)
+                statement = statement.where(Comment.post_id.in_(posts))
+        if since is not None:
+            statement = statement.where(func.coalesce(model.last_edit, model.created) >= since)
+        statements.append((kind, statement))
+    return statements
+
+
+def to_ndjson(kind, rows) -> bytes:
+    """Превращает порцию строк в NDJSON: по JSON-объекту с полем type на строку."""
+    return b''.join(dumps(dict(row, type=kind)) + b'\n' for row in rows)
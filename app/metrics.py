@@ -0,0 +1,151 @@
+import re
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+from sanic.log import logger
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+from main import app, make_session
+
+# Статистика текущего запроса. Переменная контекста копируется в потоки db_executor (см. app/db.py),
+# поэтому SQL-запросы, выполненные для обработчика, записываются в его статистику.
+current_request = ContextVar('current_request', default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels='') -> list:
+        lines, cumulative = [], 0
+        separator = ',' if labels else ''
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class RequestStats:
+    """SQL-запросы, выполненные при обработке одного HTTP-запроса."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = []
+        self.rows = 0
+
+    @property
+    def sql_time(self) -> float:
+        return sum(duration for _, duration in self.statements)
+
+
+class Registry:
+    """Метрики воркера. Каждый воркер ведёт собственные метрики и отдаёт их на /metrics."""
+
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.statements = defaultdict(lambda: Histogram(COUNT_BUCKETS))
+        self.sql_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.rows = defaultdict(lambda: Histogram(COUNT_BUCKETS))
+        self.response_size = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.pool_wait = Histogram(LATENCY_BUCKETS)
+        # функции, возвращающие дополнительные строки метрик других модулей (например, app/replicas.py)
+        self.collectors = []
+
+    def record(self, route, method, status, stats, duration, size):
+        labels = f'route="{route}",method="{method}"'
+        self.requests[f'{labels},status="{status}"'] += 1
+        self.latency[labels].observe(duration)
+        self.statements[labels].observe(len(stats.statements))
+        self.sql_time[labels].observe(stats.sql_time)
+        self.rows[labels].observe(stats.rows)
+        if size is not None:
+            self.response_size[labels].observe(size)
+
+    def render(self) -> str:
+        lines = ['# TYPE sanicboard_requests_total counter']
+        lines.extend(f'sanicboard_requests_total{{{labels}}} {count}' for labels, count in self.requests.items())
+        for name, histograms in (('sanicboard_request_duration_seconds', self.latency),
+                                 ('sanicboard_request_sql_statements', self.statements),
+                                 ('sanicboard_request_sql_duration_seconds', self.sql_time),
+                                 ('sanicboard_request_sql_rows', self.rows),
+                                 ('sanicboard_response_size_bytes', self.response_size)):
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in histograms.items():
+                lines.extend(histogram.render(name, labels))
+
+        lines.append('# TYPE sanicboard_db_pool_wait_seconds histogram')
+        lines.extend(self.pool_wait.render('sanicboard_db_pool_wait_seconds'))
+        engine = make_session.kw.get('bind')
+        if engine is not None and hasattr(engine.pool, 'checkedout'):
+            lines.append('# TYPE sanicboard_db_pool_connections gauge')
+            lines.append(f'sanicboard_db_pool_connections{{state="in_use"}} {engine.pool.checkedout()}')
+            lines.append(f'sanicboard_db_pool_connections{{state="idle"}} {engine.pool.checkedin()}')
+            lines.append(f'sanicboard_db_pool_connections{{state="size"}} {engine.pool.size()}')
+        for collect in self.collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def route_label(path) -> str:
+    """Путь запроса без идентификаторов, чтобы метрики группировались по маршруту: /get_post/<id>"""
+    return re.sub(r'/\d+', '/<id>', path).replace('\\', '\\\\').replace('"', '\\"')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started'].pop()
+    stats = current_request.get()
+    if stats is not None:
+        stats.statements.append((statement, duration))
+        if cursor.description is not None and cursor.rowcount > 0:
+            stats.rows += cursor.rowcount
+
+
+@app.middleware('request')
+async def start_request_metrics(request):
+    request['metrics'] = stats = RequestStats()
+    current_request.set(stats)
+
+
+@app.middleware('response')
+async def record_request_metrics(request, response):
+    stats = request.get('metrics')
+    if stats is None:
+        return
+    duration = time.perf_counter() - stats.started
+    # Несуществующие пути не заводят отдельных меток, иначе их число не ограничено
+    route = route_label(request.path) if response.status != 404 else '<unmatched>'
+    body = getattr(response, 'body', None)  # у потоковых ответов тела нет
+    registry.record(route, request.method, response.status, stats, duration, len(body) if body is not None else None)
+
+    if config.SLOW_REQUEST_MS and duration * 1000 >= config.SLOW_REQUEST_MS:
+        statements = '\n'.join(f'  {spent * 1000:.1f} ms: {statement}' for statement, spent in stats.statements)
+        logger.warning(f'Slow request {request.method} {request.path}?{request.query_string}: '
+                       f'{duration * 1000:.1f} ms, {len(stats.statements)} SQL statements\n{statements}')
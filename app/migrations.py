@@ -0,0 +1,83 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, select
+from sqlalchemy.schema import CreateIndex
+
+from app.models import Base, Category, Post, Comment, PostActivity, search_indexes, listing_indexes
+
+# Номера применённых миграций. Таблица в отдельных метаданных: это служебная таблица, а не модель приложения
+schema_metadata = MetaData()
+schema_versions = Table('schema_versions', schema_metadata,
+                        Column('version', Integer, primary_key=True),
+                        Column('description', String),
+                        Column('applied', DateTime, default=datetime.utcnow))
+
+# Миграции схемы (номер, описание, функция изменения схемы), см. migration
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """
+    Регистрирует функцию, изменяющую схему, как миграцию с номером version.
+    Функция получает соединение и выполняется в транзакции вместе с записью номера в schema_versions.
+    Миграции должны работать и на базах, созданных прежним create_schema (CREATE ... IF NOT EXISTS).
+    """
+    def decorator(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        return upgrade
+    return decorator
+
+
+def create_index(connection, index):
+    """Создаёт индекс, если его ещё нет (Postgres 9.5+, SQLite)"""
+    ddl = str(CreateIndex(index).compile(dialect=connection.dialect))
+    connection.execute(ddl.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+
+
+@migration(1, 'Tables categories, posts and comments')
+def create_tables(connection):
+    Base.metadata.create_all(connection, tables=[Category.__table__, Post.__table__, Comment.__table__])
+
+
+@migration(2, 'Full-text search indexes')
+def create_search_indexes(connection):
+    # на базах, созданных до появления поиска, индексов нет: create_all не меняет существующие таблицы
+    if connection.dialect.name == 'postgresql':
+        for index in search_indexes:
+            create_index(connection, index)
+
+
+@migration(3, 'Indexes for pagination, counters, threads and cascade deletes')
+def create_listing_indexes(connection):
+    for index in listing_indexes:
+        create_index(connection, index)
+
+
+@migration(4, 'Table post_activity')
+def create_post_activity(connection):
+    Base.metadata.create_all(connection, tables=[PostActivity.__table__])
+
+
+def applied_versions(connection) -> set:
+    return {row.version for row in connection.execute(select([schema_versions.c.version]))}
+
+
+def migrate(engine) -> list:
+    """
+    Применяет недостающие миграции по порядку номеров в одной транзакции.
+    :return [(номер, описание), ...] применённых миграций
+    """
+    schema_metadata.create_all(engine)
+    applied = []
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # одновременно запущенные migrate (например, из нескольких контейнеров) выполняются по очереди
+            connection.execute('LOCK TABLE schema_versions IN EXCLUSIVE MODE')
+        versions = applied_versions(connection)
+        for version, description, upgrade in sorted(MIGRATIONS, key=lambda item: item[0]):
+            if version in versions:
+                continue
+            upgrade(connection)
+            connection.execute(schema_versions.insert().values(version=version, description=description))
+            applied.append((version, description))
+    return applied
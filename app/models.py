@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, event, func
+from sqlalchemy.schema import CreateIndex
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -6,6 +7,21 @@ from datetime import datetime
 
 Base = declarative_base()
 
+# Конфигурация полнотекстового поиска Postgres: без стемминга, чтобы одинаково работать для любого языка
+SEARCH_CONFIG = 'simple'
+
+
+def search_vector(*columns):
+    """
+    Возвращает выражение tsvector по текстовым колонкам.
+    Одно и то же выражение используется в GIN-индексе и в запросах поиска,
+    иначе Postgres не сможет применить индекс.
+    """
+    document = func.coalesce(columns[0], '')
+    for column in columns[1:]:
+        document = document + ' ' + func.coalesce(column, '')
+    return func.to_tsvector(SEARCH_CONFIG, document)
+
 
 class Category(Base):
     __tablename__ = 'categories'
@@ -53,3 +69,41 @@ class Comment(Base):
                f'parent_comment_id: {self.parent_comment_id},' \
                f'title: {self.title}, body: {self.body}, ' \
                f'created: {self.created}, last_edit: {self.last_edit}'
+
+
+class PostActivity(Base):
+    """
+    Просмотры и новые комментарии поста за один час (hour - номер часа от начала эпохи UTC), см. app/activity.py.
+    Внешнего ключа на posts нет: счётчики удалённого поста не мешают удалению и отбрасываются при подсчёте рейтинга.
+    """
+    __tablename__ = 'post_activity'
+    # выборка активности за окно рейтинга и удаление устаревших часов
+    __table_args__ = (Index('ix_post_activity_hour', 'hour'),)
+    post_id = Column(Integer, primary_key=True)
+    hour = Column(Integer, primary_key=True)
+    views = Column(Integer, nullable=False, default=0)
+    comments = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'post_id: {self.post_id}, hour: {self.hour}, views: {self.views}, comments: {self.comments}'
+
+
+# GIN-индексы для полнотекстового поиска по категориям и постам (см. app/search.py).
+# to_tsvector есть только в Postgres, поэтому индексы создаются лишь для этого диалекта.
+search_indexes = [
+    Index('ix_categories_search', search_vector(Category.title, Category.summary), postgresql_using='gin'),
+    Index('ix_posts_search', search_vector(Post.title, Post.body), postgresql_using='gin'),
+]
+for search_index in search_indexes:
+    search_index.table.indexes.discard(search_index)
+    event.listen(search_index.table, 'after_create', CreateIndex(search_index).execute_if(dialect='postgresql'))
+
+# Индексы под запросы приложения: выборка страниц по (created, id) внутри родителя (app/pagination.py),
+# подсчёт дочерних записей (count_by), обход веток комментариев (app/threads.py) и каскадное удаление.
+# Первые колонки индексов покрывают и простые фильтры по внешним ключам.
+listing_indexes = [
+    Index('ix_categories_created', Category.created, Category.category_id),
+    Index('ix_posts_category_created', Post.category_id, Post.created, Post.post_id),
+    Index('ix_comments_post_created', Comment.post_id, Comment.created, Comment.comment_id),
+    Index('ix_comments_parent_created', Comment.parent_comment_id, Comment.created, Comment.comment_id),
+]
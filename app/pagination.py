@@ -0,0 +1,69 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+import json
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(created: datetime, item_id: int) -> str:
+    """Упаковывает позицию последнего элемента страницы (created, id) в непрозрачную строку."""
+    raw = json.dumps([created.isoformat(), item_id]).encode()
+    return urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Распаковывает строку, полученную от encode_cursor.
+    :return (created, id) или None, если курсор не передан
+    :raise ValueError - курсор повреждён
+    """
+    if not cursor:
+        return None
+    try:
+        created, item_id = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.fromisoformat(created), int(item_id)
+    except (TypeError, ValueError) as error:
+        raise ValueError(f'Invalid cursor: {cursor}') from error
+
+
+def parse_page(limit, offset=None, cursor=None):
+    """
+    Проверяет параметры страницы из строки запроса.
+    :return (limit, offset, after); limit и offset равны None, если не переданы, after - см. decode_cursor
+    :raise ValueError - limit меньше 1, offset отрицательный, параметры не числа или курсор повреждён
+    """
+    limit = int(limit) if limit else None
+    offset = int(offset) if offset else None
+    if (limit is not None and limit < 1) or (offset is not None and offset < 0):
+        raise ValueError(f'Invalid limit or offset: {limit}, {offset}')
+    return limit, offset, decode_cursor(cursor)
+
+
+def fetch_page(query, created, pk, limit=None, offset=None, after=None):
+    """
+    Выбирает страницу строк, упорядоченных по (created, id).
+
+    Если передан offset, используется выборка limit/offset. Иначе выборка идёт по ключу:
+    берутся строки, следующие за позицией after, поэтому время ответа не зависит от глубины страницы.
+    :arg created, pk - колонки модели, задающие порядок (например, Post.created, Post.post_id)
+    :arg after - позиция (created, id), полученная из decode_cursor
+    :return (строки страницы, next_cursor); next_cursor равен None, если страница последняя
+            или используется offset
+    """
+    query = query.order_by(created, pk)
+
+    if offset is not None:
+        return query.limit(limit).offset(offset).all(), None
+
+    if after is not None:
+        query = query.filter(tuple_(created, pk) > tuple_(*after))
+    if limit is None:
+        return query.all(), None
+
+    # запрашиваем лишнюю строку, чтобы узнать, есть ли следующая страница
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, created.key), getattr(last, pk.key))
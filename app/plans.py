@@ -0,0 +1,214 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import event
+
+from app import queries
+from app.activity import current_hour, rank_posts, upsert_activity
+from app.conditional import post_state, comment_state, comment_thread_state
+from app.db import count_by, update_returning
+from app.deletes import category_tags, delete_category_tree, delete_post_tree, delete_comment_tree, _delete_comments_chunk, \
+    _delete_posts_chunk
+from app.export import export_statements
+from app.models import Category, Post, Comment
+from app.pagination import fetch_page
+from app.projection import post_projection, comment_projection
+from app.search import search_terms
+from app.serializers import columns, POST_FIELDS
+from main import make_session
+
+# Таблицы приложения: полный просмотр других (CTE веток, подзапросы) не считается проблемой
+TABLES = ('categories', 'posts', 'comments', 'post_activity')
+
+# Запросы маршрутов (имя маршрута, функция, диалекты, на которых полный просмотр таблицы ожидаем), см. route.
+# Функции строят запросы теми же построителями из app/queries.py, что и обработчики, с типичными параметрами
+ROUTES = []
+
+# Позиция курсора для проверки выборки по ключу (см. app/pagination.py)
+AFTER = (datetime(1970, 1, 1), 0)
+# Изменения и удаления проверяются на несуществующей записи, чтобы не трогать данные
+MISSING = -1
+
+
+def route(name, full_scan=()):
+    """
+    Регистрирует функцию, выполняющую те же запросы, что и маршрут name.
+    Функция получает сессию и словарь идентификаторов существующих записей (см. sample).
+    :arg full_scan - диалекты, на которых полный просмотр таблицы ожидаем, например поиск LIKE в SQLite
+    """
+    def decorator(queries):
+        ROUTES.append((name, queries, full_scan))
+        return queries
+    return decorator
+
+
+def sample(session) -> dict:
+    """Идентификаторы записей, на которых выполняются запросы; 1, если таблица пуста"""
+    post = session.query(Post.post_id, Post.category_id).order_by(Post.post_id).first()
+    reply = session.query(Comment.parent_comment_id).filter(Comment.parent_comment_id.isnot(None)).first()
+    return {'category_id': post.category_id if post else 1,
+            'post_id': post.post_id if post else 1,
+            'comment_id': reply.parent_comment_id if reply else 1}
+
+
+@route('get_categories')
+def get_categories(session, ids):
+    categories = queries.categories(session)
+    page, _ = fetch_page(categories, Category.created, Category.category_id, 20, None, AFTER)
+    count_by(session, Post.category_id, [category.category_id for category in page] or [ids['category_id']])
+
+
+@route('get_posts')
+def get_posts(session, ids):
+    posts = queries.category_posts(session, ids['category_id'], post_projection({}).columns(Post.created, Post.post_id))
+    page, _ = fetch_page(posts, Post.created, Post.post_id, 20, None, AFTER)
+    count_by(session, Comment.post_id, [post.post_id for post in page] or [ids['post_id']])
+
+
+@route('get_post')
+def get_post(session, ids):
+    post_state(session, {}, ids['post_id'])
+    queries.post(session, ids['post_id'], post_projection({}).columns()).first()
+    count_by(session, Comment.post_id, [ids['post_id']])
+    comments = queries.post_comments(session, ids['post_id'],
+                                     comment_projection({}).columns(Comment.created, Comment.comment_id))
+    page, _ = fetch_page(comments, Comment.created, Comment.comment_id, 20, None, AFTER)
+    count_by(session, Comment.parent_comment_id, [comment.comment_id for comment in page] or [ids['comment_id']])
+
+
+@route('get_comment')
+def get_comment(session, ids):
+    comment_state(session, {}, ids['comment_id'])
+    queries.comment(session, ids['comment_id']).first()
+    fetch_page(queries.nested_comments(session, ids['comment_id']), Comment.created, Comment.comment_id,
+               20, None, AFTER)
+
+
+@route('get_post_thread')
+def get_post_thread(session, ids):
+    post_state(session, {}, ids['post_id'])
+    queries.post(session, ids['post_id'], columns(Post, POST_FIELDS)).first()
+    queries.post_thread(session, ids['post_id'])
+
+
+@route('get_comment_thread')
+def get_comment_thread(session, ids):
+    comment_thread_state(session, {}, ids['comment_id'])
+    queries.comment(session, ids['comment_id']).first()
+    queries.comment_thread(session, ids['comment_id'])
+
+
+@route('search_category', full_scan=('sqlite',))
+def search_category(session, ids):
+    categories = queries.search_categories(session, search_terms('main'))
+    categories.order_by(None).count()
+    categories.limit(20).offset(0).all()
+
+
+@route('search_post', full_scan=('sqlite',))
+def search_post(session, ids):
+    posts = queries.search_posts(session, search_terms('first'), post_projection({}).columns(Post.post_id))
+    posts.order_by(None).count()
+    posts.limit(20).offset(0).all()
+
+
+@route('export')
+def export(session, ids):
+    # выгрузка без category_id - полный просмотр по замыслу, поэтому проверяется выгрузка одной категории
+    for _, statement in export_statements(ids['category_id'], AFTER[0]):
+        session.execute(statement.limit(1)).fetchall()
+
+
+@route('trending')
+def trending(session, ids):
+    upsert_activity(session, [{'post_id': ids['post_id'], 'hour': current_hour(), 'views': 1, 'comments': 0}])
+    rank_posts(session, current_hour())
+
+
+@route('edit')
+def edit(session, ids):
+    update_returning(session, Category, Category.category_id == MISSING, {'title': ''})
+    update_returning(session, Post, Post.post_id == MISSING, {'title': ''})
+    update_returning(session, Comment, Comment.comment_id == MISSING, {'title': ''})
+    queries.post_category(session, ids['post_id']).scalar()
+
+
+@route('delete')
+def delete(session, ids):
+    category_tags(session, MISSING)
+    delete_category_tree(session, MISSING)
+    delete_post_tree(session, MISSING)
+    delete_comment_tree(session, MISSING)
+    _delete_comments_chunk(session, MISSING, 1000)
+    _delete_posts_chunk(session, MISSING, 1000)
+
+
+def record_statements(connection, queries, session, ids) -> list:
+    """Выполняет queries и возвращает выполненные запросы [(sql, параметры), ...] в том виде, как их получил драйвер"""
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(connection, 'before_cursor_execute', record)
+    try:
+        queries(session, ids)
+    finally:
+        event.remove(connection, 'before_cursor_execute', record)
+    return statements
+
+
+def _walk(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _walk(child)
+
+
+def full_scans(cursor, dialect, statement, parameters) -> list:
+    """
+    Таблицы приложения, которые запрос просматривает целиком.
+    В Postgres план строится с enable_seqscan = off: Seq Scan остаётся в плане, только если
+    подходящего индекса нет, поэтому результат не зависит от размера таблиц.
+    """
+    if dialect == 'postgresql':
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+        plan = cursor.fetchone()[0][0]['Plan']
+        return [node['Relation Name'] for node in _walk(plan)
+                if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in TABLES]
+
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    scans = []
+    for row in cursor.fetchall():
+        # 'SCAN posts' - полный просмотр, 'SEARCH posts USING INDEX ...' и 'SCAN posts USING INDEX ...' - по индексу
+        match = re.match(r'SCAN (?:TABLE )?(\w+)', row[-1])
+        if match and match.group(1) in TABLES and 'USING' not in row[-1]:
+            scans.append(match.group(1))
+    return scans
+
+
+def check_plans(engine) -> list:
+    """
+    Строит планы всех запросов маршрутов и находит полные просмотры таблиц.
+    Запросы выполняются в транзакции, которая затем откатывается.
+    :return [(маршрут, таблица, sql), ...] неожиданных полных просмотров
+    """
+    dialect = engine.dialect.name
+    problems = []
+    with engine.connect() as connection:
+        transaction = connection.begin()
+        try:
+            cursor = connection.connection.cursor()
+            if dialect == 'postgresql':
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            session = make_session(bind=connection)
+            ids = sample(session)
+            for name, queries, full_scan in ROUTES:
+                if dialect in full_scan:
+                    continue
+                for statement, parameters in record_statements(connection, queries, session, ids):
+                    for table in dict.fromkeys(full_scans(cursor, dialect, statement, parameters)):
+                        problems.append((name, table, statement))
+            session.close()
+        finally:
+            transaction.rollback()
+    return problems
@@ -0,0 +1,83 @@
+from sqlalchemy import func
+
+from app.models import Post, Comment
+from app import serializers
+
+# Поля, которые можно запросить параметром fields. *_count - вычисляемые поля:
+# если они не запрошены, подсчитывающий запрос не выполняется.
+POST_FIELDS = serializers.POST_FIELDS + ('comments_count',)
+COMMENT_FIELDS = serializers.COMMENT_FIELDS + ('comments_count',)
+
+# Поля, которые не нужны в списках: view=summary отдаёт все поля, кроме них
+HEAVY_FIELDS = ('body',)
+
+
+class Projection:
+    """
+    Набор полей ответа и длина превью текста.
+    Колонки выбираются запросом SELECT только из нужных полей (см. columns), без загрузки ORM-объектов.
+    """
+
+    def __init__(self, model, fields, preview=None):
+        self.model = model
+        self.fields = fields
+        self.preview = preview
+
+    def columns(self, *required) -> list:
+        """
+        Колонки для session.query: запрошенные поля и required (например, колонки порядка для fetch_page).
+        Если задано превью, body обрезается в самом запросе до preview символов.
+        """
+        names = [name for name in self.fields if hasattr(self.model.__table__.c, name)]
+        names += [column.key for column in required if column.key not in names]
+        columns = []
+        for name in names:
+            column = getattr(self.model, name)
+            if name == 'body' and self.preview is not None:
+                column = func.substr(column, 1, self.preview).label('body')
+            columns.append(column)
+        return columns
+
+    def wants(self, field) -> bool:
+        return field in self.fields
+
+    def to_dict(self, row, **computed) -> dict:
+        """Поля строки row в порядке fields; значения вычисляемых полей передаются в computed"""
+        return {name: computed[name] if name in computed else getattr(row, name) for name in self.fields}
+
+
+def parse_projection(args, model, available, fields_arg='fields') -> Projection:
+    """
+    Разбирает параметры запроса, задающие состав ответа.
+    :arg fields_arg - имя параметра со списком полей через запятую, например fields=title,post_id
+    view=summary - все поля, кроме body; preview=<N> - body обрезается до N символов.
+    Без параметров возвращаются все поля available.
+    :raise ValueError - неизвестное поле, view или неверное значение preview
+    """
+    fields, view, preview = args.get(fields_arg), args.get('view'), args.get('preview')
+
+    if fields:
+        fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+        unknown = [field for field in fields if field not in available]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)}. Available fields: {", ".join(available)}.')
+    elif view == 'summary':
+        fields = tuple(field for field in available if field not in HEAVY_FIELDS or preview)
+    elif view in (None, 'full'):
+        fields = available
+    else:
+        raise ValueError(f'Unknown view: {view}. Available views: full, summary.')
+
+    if preview is not None:
+        if not preview.isdigit() or int(preview) < 1:
+            raise ValueError('Preview must be a positive integer.')
+        preview = int(preview)
+    return Projection(model, fields, preview)
+
+
+def post_projection(args, fields_arg='fields') -> Projection:
+    return parse_projection(args, Post, POST_FIELDS, fields_arg)
+
+
+def comment_projection(args, fields_arg='fields') -> Projection:
+    return parse_projection(args, Comment, COMMENT_FIELDS, fields_arg)
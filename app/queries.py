@@ -0,0 +1,60 @@
+from app.models import Category, Post, Comment
+from app.search import search
+from app.serializers import columns, CATEGORY_FIELDS, COMMENT_FIELDS
+from app.threads import load_thread
+
+
+# Запросы маршрутов чтения. Их строят и обработчики (app/routes.py), и проверка планов (app/plans.py),
+# поэтому manage.py check_queries проверяет ровно те запросы, которые выполняют маршруты.
+
+
+def categories(session):
+    """Все категории; страница выбирается через fetch_page по (created, category_id)"""
+    return session.query(*columns(Category, CATEGORY_FIELDS))
+
+
+def category_posts(session, category_id, entities):
+    """Посты категории; страница выбирается через fetch_page по (created, post_id)"""
+    return session.query(*entities).filter(Post.category_id == category_id)
+
+
+def post(session, post_id, entities):
+    return session.query(*entities).filter(Post.post_id == post_id)
+
+
+def post_comments(session, post_id, entities):
+    """Комментарии первого и вложенных уровней к посту; страница выбирается через fetch_page по (created, comment_id)"""
+    return session.query(*entities).filter(Comment.post_id == post_id)
+
+
+def post_category(session, post_id):
+    return session.query(Post.category_id).filter_by(post_id=post_id)
+
+
+def comment(session, comment_id):
+    return session.query(*columns(Comment, COMMENT_FIELDS)).filter(Comment.comment_id == comment_id)
+
+
+def nested_comments(session, comment_id):
+    """Ответы на комментарий; страница выбирается через fetch_page по (created, comment_id)"""
+    return session.query(*columns(Comment, COMMENT_FIELDS)).filter(Comment.parent_comment_id == comment_id)
+
+
+def post_thread(session, post_id, depth=None) -> list:
+    """Все комментарии поста до глубины depth (см. load_thread)"""
+    return load_thread(session, (Comment.post_id == post_id) & (Comment.parent_comment_id.is_(None)),
+                       depth, columns(Comment, COMMENT_FIELDS))
+
+
+def comment_thread(session, comment_id, depth=None) -> list:
+    """Все ответы на комментарий до глубины depth (см. load_thread)"""
+    return load_thread(session, Comment.parent_comment_id == comment_id, depth, columns(Comment, COMMENT_FIELDS))
+
+
+def search_categories(session, terms):
+    return search(session, Category, Category.category_id, (Category.title, Category.summary), terms,
+                  columns(Category, CATEGORY_FIELDS))
+
+
+def search_posts(session, terms, entities):
+    return search(session, Post, Post.post_id, (Post.title, Post.body), terms, entities)
@@ -0,0 +1,123 @@
+import asyncio
+import itertools
+import math
+import time
+
+from sanic.log import logger
+from sqlalchemy import text
+
+import config
+from app.db import read_engine
+from app.metrics import registry
+from main import app, create_db_engine
+
+# Cookie со временем (unix time), до которого клиент читает с основного сервера после своего изменения
+STICKY_COOKIE = 'db_primary_until'
+
+# Отставание реплики в секундах; 0, если реплика применила всё полученное от основного сервера
+LAG_QUERY = text('SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                 'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+
+class Replica:
+    def __init__(self, uri):
+        self.engine = create_db_engine(uri)
+        url = self.engine.url
+        self.name = ':'.join(str(part) for part in (url.host, url.port) if part) or url.database
+        self.healthy = False
+        self.lag = None
+
+    def check(self):
+        """Проверяет доступность реплики и её отставание (блокирующий вызов, выполняется в пуле потоков)"""
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    self.lag = float(connection.execute(LAG_QUERY).scalar() or 0)
+                else:
+                    connection.execute(text('SELECT 1'))
+                    self.lag = 0.0
+        except Exception as error:
+            if self.healthy:
+                logger.warning(f'Replica {self.name} is unavailable: {error}')
+            self.healthy, self.lag = False, None
+            return
+        self.healthy = self.lag <= config.REPLICA_MAX_LAG
+
+
+class ReplicaSet:
+    """Реплики для чтения: выбор по кругу среди доступных и периодическая проверка их состояния."""
+
+    def __init__(self):
+        self.replicas = []
+        self._counter = itertools.count()
+
+    def choose(self):
+        """Следующая доступная реплика или None, если доступных нет и читать нужно с основного сервера"""
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    async def check(self):
+        # проверки выполняются в пуле потоков по умолчанию, чтобы недоступная реплика не занимала db_executor
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, replica.check) for replica in self.replicas])
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(config.REPLICA_CHECK_INTERVAL)
+            await self.check()
+
+    def metrics(self) -> list:
+        lines = ['# TYPE sanicboard_db_replica_healthy gauge']
+        lines.extend(f'sanicboard_db_replica_healthy{{replica="{replica.name}"}} {int(replica.healthy)}'
+                     for replica in self.replicas)
+        lines.append('# TYPE sanicboard_db_replica_lag_seconds gauge')
+        lines.extend(f'sanicboard_db_replica_lag_seconds{{replica="{replica.name}"}} {replica.lag}'
+                     for replica in self.replicas if replica.lag is not None)
+        return lines
+
+
+replica_set = ReplicaSet()
+
+
+@app.listener('before_server_start')
+async def connect_replicas(app, loop):
+    if not config.DATABASE_REPLICA_URIS:
+        return
+    replica_set.replicas = [Replica(uri) for uri in config.DATABASE_REPLICA_URIS]
+    await replica_set.check()
+    app.add_task(replica_set.watch())
+    registry.collectors.append(replica_set.metrics)
+
+
+@app.listener('after_server_stop')
+async def disconnect_replicas(app, loop):
+    for replica in replica_set.replicas:
+        replica.engine.dispose()
+
+
+def is_sticky(request) -> bool:
+    """Клиент недавно изменял данные и должен читать с основного сервера"""
+    try:
+        return float(request.cookies.get(STICKY_COOKIE) or 0) > time.time()
+    except ValueError:
+        return False
+
+
+@app.middleware('request')
+async def route_reads(request):
+    if request.method not in ('GET', 'HEAD') or not replica_set.replicas or is_sticky(request):
+        return
+    replica = replica_set.choose()
+    if replica is not None:
+        read_engine.set(replica.engine)
+        request['db_replica'] = replica.name
+
+
+@app.middleware('response')
+async def stick_to_primary(request, response):
+    if request.method in ('GET', 'HEAD') or not replica_set.replicas or response.status >= 400:
+        return
+    response.cookies[STICKY_COOKIE] = str(round(time.time() + config.REPLICA_STICKY_SECONDS, 3))
+    response.cookies[STICKY_COOKIE]['max-age'] = math.ceil(config.REPLICA_STICKY_SECONDS)
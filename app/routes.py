@@ -1,24 +1,28 @@
+import config
 from main import app
-from main import make_session
-from sanic.response import json
+from sanic.response import json, stream, text
 from app.models import Category, Post, Comment
-from contextlib import contextmanager
+from app.db import run_in_db, count_by, update_returning, stream_in_db, stream_slots
+from app.pagination import fetch_page, parse_page
+from app.search import search_terms
+from app.projection import post_projection, comment_projection
+from app.serializers import respond, to_dict, columns, CATEGORY_FIELDS, POST_FIELDS, COMMENT_FIELDS
+from app.threads import build_tree
+from app.deletes import category_tags, delete_category_tree, delete_post_tree, delete_comment_tree, purge_category
+from app.cache import cached, add_cache_tags, response_cache
+from app.bulk import parse_batch, bulk_create, check_parent_comments
+from app.export import export_statements, to_ndjson
+from app.metrics import registry
+from app.events import publish, event_stream
+from app.activity import activity, trending, count_views
+from app import replicas  # noqa: F401 - регистрирует слушатели и middleware чтения с реплик
+from app import admission  # noqa: F401 - регистрирует middleware ограничения нагрузки
+from app import compression  # noqa: F401 - регистрирует middleware сжатия ответов
+from app import queries
+from app.conditional import conditional, post_state, comment_state, comment_thread_state
 from datetime import datetime
 
 
-@contextmanager
-def session_scope():
-    """Provide a transactional scope around a series of operations."""
-    session = make_session()
-    try:
-        yield session
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
-
 # -----------------------------------------------------C R E A T E------------------------------------------------------
 @app.route("/add_category", methods=['POST'])
 async def add_category(request) -> json:
@@ -31,17 +35,18 @@ async def add_category(request) -> json:
     if not title or not summary:
         return json(status=400, body=f'Parameters "title" or "summary" has not been filled.')
 
-    with session_scope() as session:
+    def create(session):
         # записываем данные в базу
         new_category = Category(title=title, summary=summary)
         session.add(new_category)
         session.commit()
 
-    return json(status=200, body={'title': new_category.title,
-                                  'summary': new_category.summary,
-                                  'category_id': new_category.category_id,
-                                  'created': new_category.created,
-                                  'last_edit': new_category.last_edit})
+        return respond(request, to_dict(new_category, CATEGORY_FIELDS))
+
+    response = await run_in_db(create)
+    if response.status == 200:
+        await response_cache.invalidate('categories')
+    return response
 
 
 @app.route("/add_post/<category_id:int>", methods=['POST'])
@@ -55,23 +60,22 @@ async def add_post(request, category_id) -> json:
     if not title or not body:
         return json(status=400, body=f'Parameters "title" or "body" has not been filled.')
 
-    with session_scope() as session:
+    def create(session):
         # проверяем, что категория существует
         if not session.query(Category).filter_by(category_id=category_id).first():
             return json(status=400, body=f'No category {category_id} in database.')
 
-    with session_scope() as session:
         # записываем данные в базу
         new_post = Post(title=title, body=body, category_id=category_id)
         session.add(new_post)
         session.commit()
 
-    return json(status=200, body={'title': new_post.title,
-                                  'body': new_post.body,
-                                  'category_id': new_post.category_id,
-                                  'post_id': new_post.post_id,
-                                  'created': new_post.created,
-                                  'last_edit': new_post.last_edit})
+        return respond(request, to_dict(new_post, POST_FIELDS))
+
+    response = await run_in_db(create)
+    if response.status == 200:
+        await response_cache.invalidate('categories', f'posts:{category_id}')
+    return response
 
 
 @app.route("add_comment/<post_id:int>", methods=['POST'])
@@ -86,25 +90,112 @@ async def add_comment(request, post_id) -> json:
     if not title or not body:
         return json(status=400, body=f'Parameters "title" or "body" has not been filled.')
 
-    with session_scope() as session:
+    parent_comment_id = request.form.get('parent_comment_id')
+    event = {}
+
+    def create(session):
         # проверяем, что пост существует
-        if not session.query(Post).filter_by(post_id=post_id).first():
+        post = session.query(Post).filter_by(post_id=post_id).first()
+        if not post:
             return json(status=400, body=f'No post {post_id} in database.')
 
-    with session_scope() as session:
         # записываем данные в базу
-        parent_comment_id = request.form.get('parent_comment_id')
         new_comment = Comment(title=title, body=body, post_id=post_id, parent_comment_id=parent_comment_id)
         session.add(new_comment)
         session.commit()
 
-        return json(status=200, body={'title': new_comment.title,
-                                      'body': new_comment.body,
-                                      'post_id': new_comment.post_id,
-                                      'comment_id': new_comment.comment_id,
-                                      'parent_comment_id': new_comment.parent_comment_id,
-                                      'created': new_comment.created,
-                                      'last_edit': new_comment.last_edit})
+        event.update(to_dict(new_comment, COMMENT_FIELDS), category_id=post.category_id)
+        return respond(request, to_dict(new_comment, COMMENT_FIELDS))
+
+    response = await run_in_db(create)
+    if response.status == 200:
+        await response_cache.invalidate(f'post:{post_id}', f'posts:{event["category_id"]}')
+        await publish(([f'post:{post_id}', f'category:{event["category_id"]}'], 'comment_added', event))
+        activity.add(post_id, comments=1)
+    return response
+
+@app.route("/add_categories", methods=['POST'])
+async def add_categories(request) -> json:
+    """
+    Пакетное создание категорий. Тело - JSON-массив или NDJSON (Content-Type: application/x-ndjson).
+    :body [{title, summary}, ...] - заголовки и описания категорий (mandatory)
+    """
+    try:
+        items = parse_batch(request)
+    except ValueError as error:
+        return json(status=400, body={'Error': str(error)})
+
+    def create(session):
+        return bulk_create(session, Category, items, ('title', 'summary'))
+
+    results = await run_in_db(create)
+    if any('category_id' in result for result in results):
+        await response_cache.invalidate('categories')
+    return respond(request, results)
+
+
+@app.route("/add_posts", methods=['POST'])
+async def add_posts(request) -> json:
+    """
+    Пакетное создание постов. Тело - JSON-массив или NDJSON (Content-Type: application/x-ndjson).
+    :body [{category_id, title, body}, ...] - категории, заголовки и тела постов (mandatory)
+    """
+    try:
+        items = parse_batch(request)
+    except ValueError as error:
+        return json(status=400, body={'Error': str(error)})
+
+    def create(session):
+        return bulk_create(session, Post, items, ('title', 'body'),
+                           references=[('category_id', Category.category_id, 'category')])
+
+    results = await run_in_db(create)
+    categories = {items[index]['category_id'] for index, result in enumerate(results) if 'post_id' in result}
+    if categories:
+        await response_cache.invalidate('categories', *[f'posts:{category_id}' for category_id in categories])
+    return respond(request, results)
+
+
+@app.route("/add_comments", methods=['POST'])
+async def add_comments(request) -> json:
+    """
+    Пакетное создание комментариев. Тело - JSON-массив или NDJSON (Content-Type: application/x-ndjson).
+    :body [{post_id, title, body, parent_comment_id}, ...] - посты, заголовки и тела комментариев (mandatory),
+                                                             parent_comment_id (optional)
+    """
+    try:
+        items = parse_batch(request)
+    except ValueError as error:
+        return json(status=400, body={'Error': str(error)})
+
+    affected, events = [], []
+
+    def create(session):
+        results = bulk_create(session, Comment, items, ('title', 'body'),
+                              references=[('post_id', Post.post_id, 'post')],
+                              optional=('parent_comment_id',), check=check_parent_comments)
+        created = [(items[index], result['comment_id']) for index, result in enumerate(results)
+                   if 'comment_id' in result]
+        posts = {item['post_id'] for item, _ in created}
+        if posts:
+            categories = dict(session.query(Post.post_id, Post.category_id).filter(Post.post_id.in_(posts)))
+            affected.extend([f'post:{post_id}' for post_id in posts] +
+                            [f'posts:{category_id}' for category_id in set(categories.values())])
+            for item, comment_id in created:
+                category_id = categories[item['post_id']]
+                events.append(([f'post:{item["post_id"]}', f'category:{category_id}'], 'comment_added',
+                               {'title': item['title'], 'body': item['body'], 'comment_id': comment_id,
+                                'post_id': item['post_id'], 'parent_comment_id': item.get('parent_comment_id'),
+                                'category_id': category_id}))
+        return results
+
+    results = await run_in_db(create)
+    if affected:
+        await response_cache.invalidate(*affected)
+        await publish(*events)
+        for _, _, comment in events:
+            activity.add(comment['post_id'], comments=1)
+    return respond(request, results)
 
 # -----------------------------------------------------U P D A T E------------------------------------------------------
 @app.route("/edit_category/<category_id:int>", methods=['POST'])
@@ -118,26 +209,22 @@ async def edit_category(request, category_id) -> json:
     if not title and not summary:
         return json(status=400, body=f'Parameters "title" or "summary" has not been filled.')
 
-    with session_scope() as session:
-        # проверяем, что категория существует
-        category = session.query(Category).filter_by(category_id=category_id)
-        if not category.first():
-            return json(status=400, body=f'No category {category_id} in database.')
+    values = {name: value for name, value in (('title', title), ('summary', summary)) if value}
 
-        if category.first().title == title or category.first().summary == summary:
+    def edit(session):
+        # изменяем категорию и получаем её новое состояние одним запросом
+        edited_category = update_returning(session, Category, Category.category_id == category_id, values)
+        if not edited_category:
+            if not session.query(Category.category_id).filter_by(category_id=category_id).first():
+                return json(status=400, body=f'No category {category_id} in database.')
             return json(status=400, body=f'Nothing to change')
 
-        if title:
-            category.update({'title': title, 'last_edit': datetime.utcnow()})
-        if summary:
-            category.update({'summary': summary, 'last_edit': datetime.utcnow()})
+        return respond(request, to_dict(edited_category, CATEGORY_FIELDS))
 
-    edited_category = category.first()
-    return json(status=200, body={'title': edited_category.title,
-                                  'summary': edited_category.summary,
-                                  'category_id': edited_category.category_id,
-                                  'created': edited_category.created,
-                                  'last_edit': edited_category.last_edit})
+    response = await run_in_db(edit)
+    if response.status == 200:
+        await response_cache.invalidate('categories')
+    return response
 
 
 @app.route("/edit_post/<post_id:int>", methods=['POST'])
@@ -151,26 +238,24 @@ async def edit_post(request, post_id) -> json:
     if not title and not body:
         return json(status=400, body=f'Parameters "title" or "body" has not been filled.')
 
-    with session_scope() as session:
-        # проверяем, что пост существует
-        post = session.query(Post).filter_by(post_id=post_id)
-        if not post.first():
-            return json(status=400, body=f'No post {post_id} in database.')
+    values = {name: value for name, value in (('title', title), ('body', body)) if value}
+    affected = [f'post:{post_id}']
 
-        if post.first().title == title or post.first().body == body:
+    def edit(session):
+        # изменяем пост и получаем его новое состояние одним запросом
+        edited_post = update_returning(session, Post, Post.post_id == post_id, values)
+        if not edited_post:
+            if not session.query(Post.post_id).filter_by(post_id=post_id).first():
+                return json(status=400, body=f'No post {post_id} in database.')
             return json(status=400, body=f'Nothing to change')
+        affected.append(f'posts:{edited_post.category_id}')
 
-        if title:
-            post.update({'title': title, 'last_edit': datetime.utcnow()})
-        if body:
-            post.update({'body': body, 'last_edit': datetime.utcnow()})
+        return respond(request, to_dict(edited_post, POST_FIELDS))
 
-    edited_category = post.first()
-    return json(status=200, body={'title': edited_category.title,
-                                  'body': edited_category.body,
-                                  'category_id': edited_category.category_id,
-                                  'created': edited_category.created,
-                                  'last_edit': edited_category.last_edit})
+    response = await run_in_db(edit)
+    if response.status == 200:
+        await response_cache.invalidate(*affected)
+    return response
 
 
 @app.route("/edit_comment/<comment_id:int>", methods=['POST'])
@@ -184,298 +269,493 @@ async def edit_comment(request, comment_id) -> json:
     if not title and not body:
         return json(status=400, body=f'Parameters "title" or "body" has not been filled.')
 
-    with session_scope() as session:
-        # проверяем, что комментарий существует
-        comment = session.query(Comment).filter_by(comment_id=comment_id)
-        if not comment.first():
-            return json(status=400, body=f'No comment {comment_id} in database.')
+    values = {name: value for name, value in (('title', title), ('body', body)) if value}
+    affected, event = [], {}
 
-        if comment.first().title == title or comment.first().body == body:
+    def edit(session):
+        # изменяем комментарий и получаем его новое состояние одним запросом
+        edited_comment = update_returning(session, Comment, Comment.comment_id == comment_id, values)
+        if not edited_comment:
+            if not session.query(Comment.comment_id).filter_by(comment_id=comment_id).first():
+                return json(status=400, body=f'No comment {comment_id} in database.')
             return json(status=400, body=f'Nothing to change')
+        affected.append(f'post:{edited_comment.post_id}')
+        # категория нужна только подписчикам событий: список постов категории от комментариев не зависит
+        category_id = queries.post_category(session, edited_comment.post_id).scalar()
+        event.update(to_dict(edited_comment, COMMENT_FIELDS), category_id=category_id)
 
-        if title:
-            comment.update({'title': title, 'last_edit': datetime.utcnow()})
-        if body:
-            comment.update({'body': body, 'last_edit': datetime.utcnow()})
+        return respond(request, to_dict(edited_comment, COMMENT_FIELDS))
 
-    edited_comment = comment.first()
-    return json(status=200, body={'title': edited_comment.title,
-                                  'body': edited_comment.body,
-                                  'post_id': edited_comment.post_id,
-                                  'comment_id': edited_comment.comment_id,
-                                  'parent_comment_id': edited_comment.parent_comment_id,
-                                  'created': edited_comment.created,
-                                  'last_edit': edited_comment.last_edit})
+    response = await run_in_db(edit)
+    if response.status == 200:
+        await response_cache.invalidate(*affected)
+        await publish((affected + [f'category:{event["category_id"]}'], 'comment_edited', event))
+    return response
 
 
 # -----------------------------------------------------G E T------------------------------------------------------------
 @app.route("/get_categories", methods=['GET'])
+@cached('categories')
+@conditional()
 async def get_categories(request) -> json:
     """
     Example: /get_categories?limit=20&offset=0
+    Example: /get_categories?limit=20&cursor=<next_cursor из предыдущего ответа>
 
     :arg limit - максимальное количество элементов в выдаче (mandatory)
     :arg offset - индекс элемента, с которого будет запрошен новый набор элементов
+    :arg cursor - позиция, после которой будет запрошен новый набор элементов (если offset не указан)
+    :arg with_count - вернуть общее количество категорий при выборке по cursor (optional)
     """
     offset = request.args.get('offset')
     limit = request.args.get('limit')
-    if not offset or not limit:
-        return json(status=400, body={'Error': 'Offset and limit are mandatory parameters.'})
-
-    with session_scope() as session:
-        categories = session.query(Category)
-        if categories.count() == 0:
+    with_count = offset or request.args.get('with_count')
+    if not limit:
+        return json(status=400, body={'Error': 'Limit is a mandatory parameter.'})
+    try:
+        limit, offset, after = parse_page(limit, offset, request.args.get('cursor'))
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid limit, offset or cursor.'})
+
+    def fetch(session):
+        categories = queries.categories(session)
+        page, next_cursor = fetch_page(categories, Category.created, Category.category_id, limit, offset, after)
+        if not page and not categories.first():
             return json(status=400, body='No categories was found.')
 
-        chunk = list()
-        for category in categories.limit(limit).offset(offset):
-            chunk.append({
-                'title': category.title,
-                'summary': category.summary,
-                'category_id': category.category_id,
-                'created': category.created,
-                'last_edit': category.last_edit,
-                'posts_count': category.posts.count()
-            })
-        chunk.append({'all_categories_count': categories.count()})
-        return json(status=200, body=chunk)
+        # количество постов для всей страницы получаем одним запросом
+        posts_count = count_by(session, Post.category_id, [category.category_id for category in page])
+
+        chunk = [to_dict(category, CATEGORY_FIELDS, posts_count=posts_count.get(category.category_id, 0))
+                 for category in page]
+        tail = {'all_categories_count': categories.count()} if with_count else {}
+        if offset is None:
+            tail['next_cursor'] = next_cursor
+        chunk.append(tail)
+        return respond(request, chunk)
+
+    return await run_in_db(fetch)
 
 
 @app.route("/get_posts/<category_id:int>", methods=['GET'])
+@cached('posts:{category_id}')
+@conditional()
 async def get_posts(request, category_id) -> json:
     """
     Example: /get_posts/10?limit=20&offset=0
+    Example: /get_posts/10?limit=20&cursor=<next_cursor из предыдущего ответа>
 
     :arg limit - максимальное количество элементов в выдаче (mandatory)
     :arg offset - индекс элемента, с которого будет запрошен новый набор элементов
+    :arg cursor - позиция, после которой будет запрошен новый набор элементов (если offset не указан)
+    :arg with_count - вернуть общее количество постов при выборке по cursor (optional)
+    :arg fields - поля постов через запятую, например fields=title,post_id,created (optional)
+    :arg view - summary: все поля, кроме body (optional)
+    :arg preview - обрезать body до указанного количества символов (optional)
     """
     offset = request.args.get('offset')
     limit = request.args.get('limit')
-    if not offset or not limit:
-        return json(status=400, body={'Error': 'Offset and limit are mandatory parameters.'})
-
-    with session_scope() as session:
-        posts = session.query(Post).filter_by(category_id=category_id)
-        if posts.count() == 0:
+    with_count = offset or request.args.get('with_count')
+    if not limit:
+        return json(status=400, body={'Error': 'Limit is a mandatory parameter.'})
+    try:
+        limit, offset, after = parse_page(limit, offset, request.args.get('cursor'))
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid limit, offset or cursor.'})
+    try:
+        projection = post_projection(request.args)
+    except ValueError as error:
+        return json(status=400, body={'Error': str(error)})
+
+    def fetch(session):
+        # выбираются только нужные колонки, без загрузки ORM-объектов
+        posts = queries.category_posts(session, category_id, projection.columns(Post.created, Post.post_id))
+        page, next_cursor = fetch_page(posts, Post.created, Post.post_id, limit, offset, after)
+        if not page and not posts.first():
             return json(status=400, body='No posts was found.')
 
-        chunk = list()
-        for post in posts.limit(limit).offset(offset):
-            chunk.append({
-                'title': post.title,
-                'body': post.body,
-                'category_id': post.category_id,
-                'post_id': post.post_id,
-                'created': post.created,
-                'last_edit': post.last_edit,
-                'comments_count': post.comments.count()
-            })
-        chunk.append({'all_posts_count': posts.count()})
-        return json(status=200, body=chunk)
+        # количество комментариев для всей страницы получаем одним запросом
+        comments_count = count_by(session, Comment.post_id, [post.post_id for post in page]) \
+            if projection.wants('comments_count') else {}
+
+        chunk = [projection.to_dict(post, comments_count=comments_count.get(post.post_id, 0)) for post in page]
+        tail = {'all_posts_count': posts.count()} if with_count else {}
+        if offset is None:
+            tail['next_cursor'] = next_cursor
+        chunk.append(tail)
+        return respond(request, chunk)
+
+    return await run_in_db(fetch)
 
 
 @app.route("/get_post/<post_id:int>", methods=['GET'])
+@count_views
+@cached('post:{post_id}')
+@conditional(post_state)
 async def get_post(request, post_id) -> json:
     """
     Example: /get_post?limit=20&offset=0
-    limit и offset применяются только для комментариев, оставленных к посту.
+    Example: /get_post?limit=20&cursor=<next_cursor из предыдущего ответа>
+    limit, offset и cursor применяются только для комментариев, оставленных к посту.
 
     :arg limit - максимальное количество элементов в выдаче (mandatory)
     :arg offset - индекс элемента, с которого будет запрошен новый набор элементов
+    :arg cursor - позиция, после которой будет запрошен новый набор элементов (если offset не указан)
+    :arg fields - поля поста через запятую, например fields=title,created (optional)
+    :arg comment_fields - поля комментариев через запятую (optional)
+    :arg view - summary: все поля поста и комментариев, кроме body (optional)
+    :arg preview - обрезать body поста и комментариев до указанного количества символов (optional)
     """
     offset = request.args.get('offset')
-    limit = request.args.get('limit')
-
-    with session_scope() as session:
-        post = session.query(Post).filter_by(post_id=post_id).first()
+    try:
+        limit, offset, after = parse_page(request.args.get('limit'), offset, request.args.get('cursor'))
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid limit, offset or cursor.'})
+    try:
+        post_fields = post_projection(request.args)
+        comment_fields = comment_projection(request.args, 'comment_fields')
+    except ValueError as error:
+        return json(status=400, body={'Error': str(error)})
+
+    def fetch(session):
+        post = queries.post(session, post_id, post_fields.columns()).first()
+        if not post:
+            return json(status=400, body=f'No post {post_id} in database.')
         chunk = dict()
 
-        chunk['post'] = {
-                'title': post.title,
-                'body': post.body,
-                'category_id': post.category_id,
-                'post_id': post.post_id,
-                'created': post.created,
-                'last_edit': post.last_edit,
-                'comments_count': post.comments.count()
-            }
-
-        chunk['comments'] = []
-        for comment in post.comments.limit(limit).offset(offset):
-            chunk['comments'].append(
-                {
-                    'title': comment.title,
-                    'body': comment.body,
-                    'post_id': comment.post_id,
-                    'parent_comment_id': comment.parent_comment_id,
-                    'created': comment.created,
-                    'last_edit': comment.last_edit,
-                    'comments_count': comment.comments.count()
-                }
-            )
-    return json(status=200, body=chunk)
+        comments_count = count_by(session, Comment.post_id, [post_id]) if post_fields.wants('comments_count') else {}
+        chunk['post'] = post_fields.to_dict(post, comments_count=comments_count.get(post_id, 0))
+
+        comments = queries.post_comments(session, post_id, comment_fields.columns(Comment.created, Comment.comment_id))
+        page, chunk['next_cursor'] = fetch_page(comments, Comment.created, Comment.comment_id, limit, offset, after)
+        # количество ответов на каждый комментарий страницы получаем одним запросом
+        nested_count = count_by(session, Comment.parent_comment_id, [comment.comment_id for comment in page]) \
+            if comment_fields.wants('comments_count') else {}
+
+        chunk['comments'] = [comment_fields.to_dict(comment, comments_count=nested_count.get(comment.comment_id, 0))
+                             for comment in page]
+        return respond(request, chunk)
+
+    return await run_in_db(fetch)
 
 
 @app.route("/get_comment/<comment_id:int>", methods=['GET'])
+@cached()
+@conditional(comment_state)
 async def get_comment(request, comment_id) -> json:
     """
     Example: /get_comment?limit=20&offset=0
-    limit и offset применяются только для комментариев, оставленных к запрошенному комментарию.
+    Example: /get_comment?limit=20&cursor=<next_cursor из предыдущего ответа>
+    limit, offset и cursor применяются только для комментариев, оставленных к запрошенному комментарию.
 
     :arg limit - максимальное количество элементов в выдаче (mandatory)
     :arg offset - индекс элемента, с которого будет запрошен новый набор элементов
+    :arg cursor - позиция, после которой будет запрошен новый набор элементов (если offset не указан)
     """
     offset = request.args.get('offset')
-    limit = request.args.get('limit')
+    try:
+        limit, offset, after = parse_page(request.args.get('limit'), offset, request.args.get('cursor'))
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid limit, offset or cursor.'})
 
-    with session_scope() as session:
-        comment = session.query(Comment).filter_by(comment_id=comment_id).first()
+    def fetch(session):
+        comment = queries.comment(session, comment_id).first()
+        if not comment:
+            return json(status=400, body=f'No comment {comment_id} in database.')
+        add_cache_tags(request, f'post:{comment.post_id}')
         chunk = dict()
 
-        chunk['comment'] = {
-            'title': comment.title,
-            'body': comment.body,
-            'comment_id': comment.comment_id,
-            'post_id': comment.post_id,
-            'created': comment.created,
-            'last_edit': comment.last_edit,
-            'parent_comment_id': comment.parent_comment_id,
-        }
-        nested_comments = session.query(Comment).filter_by(parent_comment_id=comment_id)
-        chunk['nested_comments'] = []
-        for comment in nested_comments.limit(limit).offset(offset):
-            chunk['nested_comments'].append(
-                {
-                    'title': comment.title,
-                    'body': comment.body,
-                    'post_id': comment.post_id,
-                    'parent_comment_id': comment.parent_comment_id,
-                    'created': comment.created,
-                    'last_edit': comment.last_edit
-                }
-            )
-    return json(status=200, body=chunk)
+        chunk['comment'] = to_dict(comment, COMMENT_FIELDS)
+        nested_comments = queries.nested_comments(session, comment_id)
+        page, chunk['next_cursor'] = fetch_page(nested_comments, Comment.created, Comment.comment_id,
+                                                limit, offset, after)
+        chunk['nested_comments'] = [to_dict(comment, COMMENT_FIELDS) for comment in page]
+        return respond(request, chunk)
+
+    return await run_in_db(fetch)
+
+
+def comment_to_dict(comment) -> dict:
+    return to_dict(comment, COMMENT_FIELDS)
+
+
+@app.route("/get_post_thread/<post_id:int>", methods=['GET'])
+@count_views
+@cached('post:{post_id}')
+@conditional(post_state)
+async def get_post_thread(request, post_id) -> json:
+    """
+    Example: /get_post_thread/10?depth=3
+    Возвращает пост со всеми комментариями в виде дерева за один запрос к API.
+    Ответы на комментарий находятся в его поле comments.
+
+    :arg depth - максимальная глубина вложенности комментариев (optional)
+    """
+    depth = request.args.get('depth')
+    if depth and (not depth.isdigit() or int(depth) < 1):
+        return json(status=400, body={'Error': 'Depth must be a positive integer.'})
+
+    def fetch(session):
+        post = queries.post(session, post_id, columns(Post, POST_FIELDS)).first()
+        if not post:
+            return json(status=400, body=f'No post {post_id} in database.')
+
+        comments = queries.post_thread(session, post_id, depth and int(depth))
+        return respond(request, {'post': to_dict(post, POST_FIELDS), 'comments': build_tree(comments, comment_to_dict)})
+
+    return await run_in_db(fetch)
+
+
+@app.route("/get_comment_thread/<comment_id:int>", methods=['GET'])
+@cached()
+@conditional(comment_thread_state)
+async def get_comment_thread(request, comment_id) -> json:
+    """
+    Example: /get_comment_thread/10?depth=3
+    Возвращает комментарий со всеми вложенными комментариями в виде дерева за один запрос к API.
+    Ответы на комментарий находятся в его поле comments.
+
+    :arg depth - максимальная глубина вложенности комментариев (optional)
+    """
+    depth = request.args.get('depth')
+    if depth and (not depth.isdigit() or int(depth) < 1):
+        return json(status=400, body={'Error': 'Depth must be a positive integer.'})
+
+    def fetch(session):
+        comment = queries.comment(session, comment_id).first()
+        if not comment:
+            return json(status=400, body=f'No comment {comment_id} in database.')
+        add_cache_tags(request, f'post:{comment.post_id}')
+
+        nested_comments = queries.comment_thread(session, comment_id, depth and int(depth))
+        return respond(request, {
+            'comment': dict(comment_to_dict(comment), comments=build_tree(nested_comments, comment_to_dict))
+        })
+
+    return await run_in_db(fetch)
+
+
+@app.route("/trending", methods=['GET'])
+async def get_trending(request) -> json:
+    """
+    Example: /trending?category_id=10&limit=10
+    Популярные посты по убыванию рейтинга: просмотры и комментарии за TRENDING_WINDOW часов, вклад которых
+    уменьшается со временем (config.py). Рейтинг пересчитывается в фоне, запрос к базе не выполняется.
+
+    :arg category_id - популярные посты категории; без параметра - всех категорий (optional)
+    :arg limit - максимальное количество постов, не больше TRENDING_SIZE (optional)
+    """
+    category_id, limit = request.args.get('category_id'), request.args.get('limit')
+    try:
+        category_id = category_id and int(category_id)
+        limit = int(limit) if limit else config.TRENDING_SIZE
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid category_id or limit.'})
+    return respond(request, {'posts': trending.get(category_id)[:limit], 'refreshed': trending.refreshed})
+
+
+@app.route("/export", methods=['GET'])
+async def export(request):
+    """
+    Example: /export?category_id=10&since=2019-09-01T00:00:00
+    Потоковая выгрузка категорий, постов и комментариев в формате NDJSON.
+
+    :arg category_id - выгрузить только эту категорию с её постами и комментариями (optional)
+    :arg since - выгрузить только записи, созданные или изменённые начиная с этого момента (optional)
+    """
+    category_id, since = request.args.get('category_id'), request.args.get('since')
+    try:
+        category_id = category_id and int(category_id)
+        since = since and datetime.fromisoformat(since)
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid category_id or since.'})
+
+    if not stream_slots.acquire():
+        return json(status=503, body={'Error': 'Too many exports in progress, retry later.'},
+                    headers={'Retry-After': '1'})
+
+    async def write(response):
+        try:
+            async for kind, rows in stream_in_db(export_statements(category_id, since)):
+                await response.write(to_ndjson(kind, rows))
+        finally:
+            stream_slots.release()
+
+    return stream(write, content_type='application/x-ndjson')
+
+
+@app.route("/subscribe", methods=['GET'])
+async def subscribe(request):
+    """
+    Example: /subscribe?post_id=10&post_id=11&category_id=3
+    Подписка на добавление, изменение и удаление комментариев в постах и категориях (Server-Sent Events).
+    События: comment_added, comment_edited, comment_deleted; data - комментарий в JSON.
+
+    :arg post_id - пост, за комментариями которого нужно следить; можно указать несколько раз (optional)
+    :arg category_id - категория, за комментариями постов которой нужно следить; можно указать несколько раз (optional)
+    """
+    try:
+        topics = [f'post:{int(post_id)}' for post_id in request.args.getlist('post_id') or []] + \
+                 [f'category:{int(category_id)}' for category_id in request.args.getlist('category_id') or []]
+    except ValueError:
+        return json(status=400, body={'Error': 'post_id and category_id must be integers.'})
+    if not topics:
+        return json(status=400, body={'Error': 'At least one post_id or category_id is required.'})
+
+    return stream(event_stream(request, topics), content_type='text/event-stream',
+                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/search_category', methods=['GET'])
 async def search_category(request) -> json:
     """
-    Выполняет поиск по полному/частичному имени категории.
+    Выполняет полнотекстовый поиск по заголовку и описанию категории.
+    Результаты упорядочены по релевантности.
     :arg limit - максимальное количество элементов в выдаче (mandatory)
     :arg offset - индекс элемента, с которого будет запрошен новый набор элементов
-    :arg category_name - полное или частичное имя категории
+    :arg category_name - слова или начала слов из заголовка/описания категории
 
     Example: /search_category?category_name='Main category&limit=20&offset=0'
     """
-    category_name = request.args.get('category_name').replace("'", '')
+    category_name = request.args.get('category_name')
+    terms = search_terms(category_name)
     limit = request.args.get('limit')
     offset = request.args.get('offset')
 
-    if not limit or not offset or not category_name:
+    if not limit or not offset or not terms:
         return json(status=400, body=f'ERROR: Category_name or offset or limit has not been filled. '
                                      f'Category_name: {category_name}, offset: {offset}, limit: {limit}')
-    with session_scope() as session:
-        categories = session.query(Category).filter(Category.title.like(f'%{category_name}%'))
-        if categories.count() == 0:
+    try:
+        limit, offset, _ = parse_page(limit, offset)
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid limit or offset.'})
+
+    def fetch(session):
+        categories = queries.search_categories(session, terms)
+        all_categories_count = categories.order_by(None).count()
+        if all_categories_count == 0:
             return json(status=400, body='No categories was found.')
 
-        chunk = list()
-        for category in categories.limit(limit).offset(offset):
-            chunk.append({
-                'title': category.title,
-                'summary': category.summary,
-                'category_id': category.category_id,
-                'created': category.created,
-                'last_edit': category.last_edit,
-                'posts_count': category.posts.count()
-            })
-        chunk.append({'all_categories_count': categories.count()})
-        return json(status=200, body=chunk)
+        page = categories.limit(limit).offset(offset).all()
+        # количество постов для всей страницы получаем одним запросом
+        posts_count = count_by(session, Post.category_id, [category.category_id for category in page])
+
+        chunk = [to_dict(category, CATEGORY_FIELDS, posts_count=posts_count.get(category.category_id, 0))
+                 for category in page]
+        chunk.append({'all_categories_count': all_categories_count})
+        return respond(request, chunk)
+
+    return await run_in_db(fetch)
 
 
 @app.route('/search_post', methods=['GET'])
 async def search_post(request) -> json:
     """
-    Выполняет поиск по полному/частичному имени поста.
+    Выполняет полнотекстовый поиск по заголовку и телу поста.
+    Результаты упорядочены по релевантности.
     :arg limit - максимальное количество элементов в выдаче (mandatory)
     :arg offset - индекс элемента, с которого будет запрошен новый набор элементов
-    :arg post_name - полное или частичное имя поста
+    :arg post_name - слова или начала слов из заголовка/тела поста
+    :arg fields - поля постов через запятую, например fields=title,post_id (optional)
+    :arg view - summary: все поля, кроме body (optional)
+    :arg preview - обрезать body до указанного количества символов (optional)
 
     Example: /search_category?post_name='My first post&limit=20&offset=0'
     """
-    post_name = (request.args.get('post_name')).replace("'", '')
+    post_name = request.args.get('post_name')
+    terms = search_terms(post_name)
     limit = request.args.get('limit')
     offset = request.args.get('offset')
 
-    if not limit or not offset or not post_name:
+    if not limit or not offset or not terms:
         return json(status=400, body=f'ERROR: Post_name or offset or limit has not been filled. '
                                      f'Post_name: {post_name}, offset: {offset}, limit: {limit}')
-
-    with session_scope() as session:
-        posts = session.query(Post).filter(Post.title.like(f'%{post_name}%'))
-        if posts.count() == 0:
+    try:
+        limit, offset, _ = parse_page(limit, offset)
+    except ValueError:
+        return json(status=400, body={'Error': 'Invalid limit or offset.'})
+    try:
+        projection = post_projection(request.args)
+    except ValueError as error:
+        return json(status=400, body={'Error': str(error)})
+
+    def fetch(session):
+        posts = queries.search_posts(session, terms, projection.columns(Post.post_id))
+        all_posts_count = posts.order_by(None).count()
+        if all_posts_count == 0:
             return json(status=400, body='No posts was found.')
 
-        chunk = list()
-        for post in posts.limit(limit).offset(offset):
-            chunk.append({
-                'title': post.title,
-                'body': post.body,
-                'category_id': post.category_id,
-                'post_id': post.post_id,
-                'created': post.created,
-                'last_edit': post.last_edit,
-                'comments_count': post.comments.count()
-            })
-        chunk.append({'all_posts_count': posts.count()})
-        return json(status=200, body=chunk)
+        page = posts.limit(limit).offset(offset).all()
+        # количество комментариев для всей страницы получаем одним запросом
+        comments_count = count_by(session, Comment.post_id, [post.post_id for post in page]) \
+            if projection.wants('comments_count') else {}
+
+        chunk = [projection.to_dict(post, comments_count=comments_count.get(post.post_id, 0)) for post in page]
+        chunk.append({'all_posts_count': all_posts_count})
+        return respond(request, chunk)
+
+    return await run_in_db(fetch)
 
 
 # -----------------------------------------------------D E L E T E------------------------------------------------------
 @app.route("/delete_category/<category_id:int>", methods=['DELETE'])
 async def delete_category(request, category_id) -> json:
-    """Категория удаляется вместе с постами и комментариями"""
-    with session_scope() as session:
-        category = session.query(Category).filter_by(category_id=category_id)
-        if category.count() == 0:
+    """
+    Категория удаляется вместе с постами и комментариями
+
+    :arg background - удалить категорию в фоне порциями, не блокируя таблицы надолго (optional)
+    """
+    if request.args.get('background'):
+        def exists(session):
+            return session.query(Category.category_id).filter_by(category_id=category_id).first()
+
+        if not await run_in_db(exists):
             return json(status=400, body=f'No category {category_id} in database.')
-        else:
-            posts = session.query(Post).filter_by(category_id=category_id)
-            for post in posts:
-                comments = session.query(Comment).filter_by(post_id=post.post_id)
-                for comment in comments:
-                    # удаляем вложенные комментарии, затем родительский комментарий, затем пост и категорию
-                    nested_comments = session.query(Comment).filter_by(parent_comment_id=comment.comment_id)
-                    nested_comments.delete()
-                comments.delete()
-            posts.delete()
-            category.delete()
-            return json(status=200, body=f'Category {category_id} was successfully deleted')
+        app.add_task(purge_category(category_id))
+        await response_cache.invalidate('categories', f'category:{category_id}')
+        return respond(request, f'Category {category_id} is being deleted', status=202)
+
+    def delete(session):
+        # теги постов собираются до удаления: кэш их страниц и комментариев тоже становится недействительным
+        tags = category_tags(session, category_id)
+        return tags if delete_category_tree(session, category_id) else None
+
+    tags = await run_in_db(delete)
+    if tags is None:
+        return json(status=400, body=f'No category {category_id} in database.')
+    await response_cache.invalidate('categories', f'category:{category_id}', *tags)
+    return respond(request, f'Category {category_id} was successfully deleted')
 
 
 @app.route("/delete_post/<post_id:int>", methods=['DELETE'])
 async def delete_post(request, post_id) -> json:
     """Пост удаляется вместе с комментариями"""
-    with session_scope() as session:
-        post = session.query(Post).filter_by(post_id=post_id)
-        if post.count() == 0:
-            return json(status=400, body=f'No post {post_id} in database.')
-        else:
-            # удаляем комментарии к посту, затем пост
-            session.query(Comment).filter_by(post_id=post_id).delete()
-            post.delete()
-            return json(status=200, body=f'Post {post_id} was successfully deleted')
+    deleted = await run_in_db(delete_post_tree, post_id)
+    if not deleted:
+        return json(status=400, body=f'No post {post_id} in database.')
+    await response_cache.invalidate('categories', f'posts:{deleted.category_id}', f'post:{post_id}')
+    return respond(request, f'Post {post_id} was successfully deleted')
 
 
 @app.route("/delete_comment/<comment_id:int>", methods=['DELETE'])
 async def delete_comment(request, comment_id) -> json:
-    """Комментарий удаляется вместе с вложенными комментариями"""
-    with session_scope() as session:
-        comment = session.query(Comment).filter_by(comment_id=comment_id)
-        if comment.count() == 0:
-            return json(status=400, body=f'No comment {comment_id} in database.')
-        else:
-            # удаляем вложенные комментарии, затем родительский комментарий
-            session.query(Comment).filter_by(parent_comment_id=comment_id).delete()
-            comment.delete()
-            return json(status=200, body=f'Comment {comment_id} was successfully deleted')
+    """Комментарий удаляется вместе со всеми вложенными комментариями"""
+    deleted = await run_in_db(delete_comment_tree, comment_id)
+    if not deleted:
+        return json(status=400, body=f'No comment {comment_id} in database.')
+    await response_cache.invalidate(f'post:{deleted.post_id}', f'posts:{deleted.category_id}')
+    await publish(([f'post:{deleted.post_id}', f'category:{deleted.category_id}'], 'comment_deleted',
+                   {'comment_id': comment_id, 'post_id': deleted.post_id, 'category_id': deleted.category_id}))
+    return respond(request, f'Comment {comment_id} was successfully deleted')
+
+
+@app.route("/cache_stats", methods=['GET'])
+async def cache_stats(request) -> json:
+    """Счётчики кэша ответов: попадания, промахи, вытеснения, инвалидации"""
+    return respond(request, response_cache.stats())
+
+
+@app.route("/metrics", methods=['GET'])
+async def metrics(request):
+    """Метрики воркера в текстовом формате Prometheus: время ответа, SQL-запросы, размер ответов, пул соединений"""
+    return text(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,37 @@
+import re
+
+from sqlalchemy import and_, func, or_
+
+from app.models import SEARCH_CONFIG, search_vector
+
+
+def search_terms(phrase) -> list:
+    """
+    Разбивает поисковую фразу на слова из букв и цифр; знаки препинания, кавычки и подчёркивания отбрасываются.
+    Подчёркивание - разделитель слов в tsvector и шаблонный символ в LIKE, поэтому в слова оно не входит.
+    """
+    return re.findall(r'[^\W_]+', phrase or '')
+
+
+def search(session, model, pk, columns, terms, entities=None):
+    """
+    Строит запрос поиска по текстовым колонкам модели, упорядоченный по релевантности.
+
+    В Postgres используется полнотекстовый поиск по GIN-индексу из app/models.py: каждое слово
+    ищется как префикс, поэтому работает поиск по частичному имени. Индекс обновляется самой базой
+    при добавлении, редактировании и удалении записей.
+    На других СУБД (например, SQLite) выполняется поиск подстроки через LIKE.
+    :arg pk - первичный ключ модели, используется для стабильного порядка при равной релевантности
+    :arg columns - колонки, по которым ведётся поиск (те же, что в индексе модели)
+    :arg terms - слова, полученные из search_terms
+    :arg entities - что выбирать вместо модели, например колонки из Projection.columns (optional)
+    """
+    query = session.query(*(entities or (model,)))
+    if session.bind.dialect.name != 'postgresql':
+        conditions = [or_(*[column.like(f'%{term}%') for column in columns]) for term in terms]
+        return query.filter(and_(*conditions)).order_by(pk)
+
+    vector = search_vector(*columns)
+    ts_query = func.to_tsquery(SEARCH_CONFIG, ' & '.join(f'{term}:*' for term in terms))
+    return query.filter(vector.op('@@')(ts_query)) \
+        .order_by(func.ts_rank(vector, ts_query).desc(), pk)
@@ -0,0 +1,67 @@
+import json
+from datetime import datetime
+
+from sanic.response import HTTPResponse
+
+# orjson кодирует datetime в ISO 8601 сам и заметно быстрее стандартного json;
+# без него используется json с тем же форматом дат. MessagePack доступен, если установлен msgpack.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+CATEGORY_FIELDS = ('title', 'summary', 'category_id', 'created', 'last_edit')
+POST_FIELDS = ('title', 'body', 'category_id', 'post_id', 'created', 'last_edit')
+COMMENT_FIELDS = ('title', 'body', 'comment_id', 'post_id', 'parent_comment_id', 'created', 'last_edit')
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not serializable')
+
+
+def dumps(body) -> bytes:
+    """JSON в байтах; datetime кодируется в ISO 8601 (2019-09-01T12:30:15.123456)"""
+    if orjson is not None:
+        return orjson.dumps(body, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(body, default=_default, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def to_dict(row, fields, **extra) -> dict:
+    """
+    Словарь из полей fields строки row - ORM-объекта или строки результата запроса (session.query(колонки)).
+    :arg extra - дополнительные поля ответа, например comments_count
+    """
+    item = {field: getattr(row, field) for field in fields}
+    item.update(extra)
+    return item
+
+
+def columns(model, fields) -> list:
+    """Колонки модели для session.query(*columns(...)): строки выбираются без создания ORM-объектов"""
+    return [getattr(model, field) for field in fields]
+
+
+def media_type(request) -> str:
+    """Формат ответа по заголовку Accept: MessagePack, если клиент его просит и msgpack установлен, иначе JSON"""
+    accept = request.headers.get('Accept', '')
+    if msgpack is not None and ('application/msgpack' in accept or 'application/x-msgpack' in accept):
+        return MSGPACK
+    return JSON
+
+
+def respond(request, body, status=200) -> HTTPResponse:
+    """Ответ с телом body в формате, выбранном media_type"""
+    if media_type(request) == MSGPACK:
+        content = msgpack.packb(body, default=_default, use_bin_type=True)
+        return HTTPResponse(status=status, content_type=MSGPACK, headers={'Vary': 'Accept'}, body_bytes=content)
+    return HTTPResponse(status=status, content_type=JSON, headers={'Vary': 'Accept'}, body_bytes=dumps(body))
@@ -1,10 +1,352 @@
+import asyncio
+import threading
 import unittest
+from datetime import datetime
 
+from types import SimpleNamespace
+from unittest import mock
 
-class MyTestCase(unittest.TestCase):
-    def test_something(self):
-        # TBD:
-        pass
+from sanic.compat import Header
+from sanic.request import Request
+from sanic.response import json
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.pool import StaticPool
+
+import config
+# модули app регистрируют обработчики в приложении из main при импорте, поэтому main импортируется первым
+from main import app, make_session
+from benchmark import percentile
+from app.admission import admission, RateLimiter
+from app.bulk import bulk_create, check_parent_comments
+from app.cache import LRUCache, LocalBackend, ResponseCache
+from app.compression import negotiate, COMPRESSORS
+from app.db import run_in_db, count_by, update_returning
+from app.deletes import category_tags, delete_category_tree, delete_post_tree, delete_comment_tree
+from app.migrations import migrate, MIGRATIONS
+from app.models import Category, Post, Comment
+from app.pagination import encode_cursor, decode_cursor, parse_page
+from app.search import search_terms
+from app.threads import build_tree
+
+
+class RunInDbTestCase(unittest.TestCase):
+    def setUp(self):
+        make_session.configure(bind=create_engine('sqlite://'))
+
+    def test_runs_in_db_thread(self):
+        def work(session):
+            return threading.current_thread().name, session.execute('SELECT 1').scalar()
+
+        async def scenario():
+            return await run_in_db(work), threading.current_thread().name
+
+        (thread, value), loop_thread = asyncio.run(scenario())
+        self.assertTrue(thread.startswith('db'))
+        self.assertNotEqual(thread, loop_thread)
+        self.assertEqual(value, 1)
+
+
+class CursorTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        created = datetime(2019, 9, 1, 12, 30, 15, 123456)
+        self.assertEqual(decode_cursor(encode_cursor(created, 42)), (created, 42))
+
+    def test_missing_cursor(self):
+        self.assertIsNone(decode_cursor(None))
+
+    def test_broken_cursor(self):
+        with self.assertRaises(ValueError):
+            decode_cursor('not-a-cursor')
+
+    def test_page_params(self):
+        self.assertEqual(parse_page('20', '0'), (20, 0, None))
+        self.assertEqual(parse_page(None), (None, None, None))
+        for limit, offset in (('0', None), ('-1', None), ('20', '-5'), ('20', 'abc'), ('many', None)):
+            with self.assertRaises(ValueError):
+                parse_page(limit, offset)
+
+
+class SearchTermsTestCase(unittest.TestCase):
+    def test_words(self):
+        self.assertEqual(search_terms("'My first post!"), ['My', 'first', 'post'])
+        self.assertEqual(search_terms('snake_case, C++ & co.'), ['snake', 'case', 'C', 'co'])
+
+    def test_no_words(self):
+        self.assertEqual(search_terms('_ % :* &|!'), [])
+        self.assertEqual(search_terms(None), [])
+
+
+class NegotiateTestCase(unittest.TestCase):
+    def setUp(self):
+        # br и gzip, как при установленном пакете brotli, независимо от окружения тестов
+        patcher = mock.patch.dict(COMPRESSORS, {'br': bytes, 'gzip': bytes}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_server_preference(self):
+        self.assertEqual(negotiate('gzip, deflate, br'), 'br')
+        self.assertEqual(negotiate('GZIP'), 'gzip')
+
+    def test_quality(self):
+        self.assertEqual(negotiate('br;q=0.5, gzip;q=0.8'), 'gzip')
+        self.assertEqual(negotiate('br; q=0, gzip'), 'gzip')
+        self.assertEqual(negotiate('br;q=abc, gzip;q=0.1'), 'gzip')
+
+    def test_wildcard(self):
+        self.assertEqual(negotiate('*'), 'br')
+        self.assertEqual(negotiate('*, br;q=0'), 'gzip')
+        self.assertEqual(negotiate('*;q=0, identity'), None)
+
+    def test_nothing_accepted(self):
+        self.assertIsNone(negotiate(None))
+        self.assertIsNone(negotiate(''))
+        self.assertIsNone(negotiate('identity, deflate'))
+        self.assertIsNone(negotiate('gzip;q=0'))
+
+
+class BuildTreeTestCase(unittest.TestCase):
+    def test_nesting(self):
+        comments = [SimpleNamespace(comment_id=1, parent_comment_id=None),
+                     SimpleNamespace(comment_id=2, parent_comment_id=1),
+                     SimpleNamespace(comment_id=3, parent_comment_id=2),
+                     SimpleNamespace(comment_id=4, parent_comment_id=None)]
+        tree = build_tree(comments, lambda comment: {'comment_id': comment.comment_id})
+        self.assertEqual(tree, [
+            {'comment_id': 1, 'comments': [{'comment_id': 2, 'comments': [{'comment_id': 3, 'comments': []}]}]},
+            {'comment_id': 4, 'comments': []}
+        ])
+
+    def test_subtree_roots(self):
+        comments = [SimpleNamespace(comment_id=2, parent_comment_id=1)]
+        self.assertEqual(build_tree(comments, lambda comment: {}), [{'comments': []}])
+
+
+class PercentileTestCase(unittest.TestCase):
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+
+    def test_empty(self):
+        self.assertEqual(percentile([], 95), 0.0)
+
+
+class MigrateTestCase(unittest.TestCase):
+    def test_applies_once(self):
+        engine = create_engine('sqlite://')
+        self.assertEqual([version for version, _ in migrate(engine)], sorted(version for version, _, _ in MIGRATIONS))
+        self.assertEqual(migrate(engine), [])
+        indexes = {index['name'] for index in inspect(engine).get_indexes('posts')}
+        self.assertIn('ix_posts_category_created', indexes)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Схема создаётся миграциями в SQLite в памяти, self.session - сессия этой базы"""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        migrate(engine)
+        self.session = make_session(bind=engine)
+
+    def tearDown(self):
+        self.session.close()
+
+    def add(self, *rows):
+        self.session.add_all(rows)
+        self.session.commit()
+
+
+class DeleteTreeTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # пост 1: 1 <- 2 <- 3 <- 4 и 1 <- 5; пост 2: 6; категория 2 с постом 3
+        self.add(Category(category_id=1), Category(category_id=2))
+        self.add(Post(post_id=1, category_id=1), Post(post_id=2, category_id=1), Post(post_id=3, category_id=2))
+        self.add(*[Comment(comment_id=comment_id, post_id=post_id, parent_comment_id=parent_id)
+                   for comment_id, post_id, parent_id in ((1, 1, None), (2, 1, 1), (3, 1, 2), (4, 1, 3),
+                                                          (5, 1, 1), (6, 2, None), (7, 3, None))])
+
+    def comment_ids(self) -> set:
+        return {comment_id for comment_id, in self.session.query(Comment.comment_id)}
+
+    def test_comment_subtree(self):
+        self.assertEqual(delete_comment_tree(self.session, 2).post_id, 1)
+        self.assertEqual(self.comment_ids(), {1, 5, 6, 7})
+        self.assertEqual(count_by(self.session, Comment.post_id, [1, 2]), {1: 2, 2: 1})
+        self.assertEqual(count_by(self.session, Comment.parent_comment_id, [1]), {1: 1})
+        self.assertIsNone(delete_comment_tree(self.session, 2))
+
+    def test_post(self):
+        self.assertEqual(delete_post_tree(self.session, 1).category_id, 1)
+        self.assertEqual(self.comment_ids(), {6, 7})
+        self.assertEqual(count_by(self.session, Post.category_id, [1]), {1: 1})
+
+    def test_category(self):
+        self.assertEqual(delete_category_tree(self.session, 1), 1)
+        self.assertEqual(self.comment_ids(), {7})
+        self.assertEqual([post_id for post_id, in self.session.query(Post.post_id)], [3])
+        self.assertEqual(delete_category_tree(self.session, 1), 0)
+
+    def test_category_tags(self):
+        self.assertEqual(sorted(category_tags(self.session, 1)), ['post:1', 'post:2', 'posts:1'])
+        self.assertEqual(category_tags(self.session, 3), ['posts:3'])
+
+
+class BulkCreateTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add(Category(category_id=1), Post(post_id=1, category_id=1), Post(post_id=2, category_id=1))
+        self.add(Comment(comment_id=1, post_id=1))
+
+    def create_comments(self, items) -> list:
+        return bulk_create(self.session, Comment, items, ('title', 'body'),
+                           references=[('post_id', Post.post_id, 'post')],
+                           optional=('parent_comment_id',), check=check_parent_comments)
+
+    def test_partial_insert(self):
+        results = self.create_comments([
+            {'post_id': 1, 'title': 't', 'body': 'b', 'parent_comment_id': 1},
+            {'post_id': 1, 'title': '', 'body': 'b'},
+            {'post_id': 3, 'title': 't', 'body': 'b'},
+            {'post_id': 2, 'title': 't', 'body': 'b', 'parent_comment_id': 1},
+            'comment',
+            {'post_id': 2, 'title': 't', 'body': 'b'},
+        ])
+        self.assertEqual(results, [{'comment_id': 2},
+                                   {'error': 'Parameter "title" has not been filled.'},
+                                   {'error': 'No post 3 in database.'},
+                                   {'error': 'No comment 1 in post 2.'},
+                                   {'error': 'Item must be a JSON object.'},
+                                   {'comment_id': 3}])
+        self.assertEqual(count_by(self.session, Comment.post_id, [1, 2]), {1: 2, 2: 1})
+
+    def test_nothing_valid(self):
+        results = self.create_comments([{'post_id': 3, 'title': 't', 'body': 'b'}])
+        self.assertEqual(results, [{'error': 'No post 3 in database.'}])
+        self.assertEqual(count_by(self.session, Comment.post_id, [1, 2, 3]), {1: 1})
+
+    def test_id_types(self):
+        results = self.create_comments([
+            {'post_id': True, 'title': 't', 'body': 'b'},
+            {'post_id': '1', 'title': 't', 'body': 'b'},
+            {'post_id': 1, 'title': 't', 'body': 'b', 'parent_comment_id': True},
+            {'post_id': 1, 'title': 't', 'body': 'b', 'parent_comment_id': '1'},
+            {'post_id': 1, 'title': 't', 'body': 'b', 'parent_comment_id': None},
+        ])
+        self.assertEqual(results[:4], [{'error': 'Parameter "post_id" must be an integer.'}] * 2 +
+                         [{'error': 'Parameter "parent_comment_id" must be an integer.'}] * 2)
+        self.assertEqual(results[4], {'comment_id': 2})
+
+
+class UpdateReturningTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add(Post(post_id=1, category_id=1, title='old', body='body'))
+
+    def test_changed(self):
+        post = update_returning(self.session, Post, Post.post_id == 1, {'title': 'new'})
+        self.assertEqual((post.title, post.body), ('new', 'body'))
+        self.assertIsNotNone(post.last_edit)
+        self.assertEqual(self.session.query(Post.title).filter_by(post_id=1).scalar(), 'new')
+
+    def test_nothing_to_change(self):
+        self.assertIsNone(update_returning(self.session, Post, Post.post_id == 1, {'title': 'old', 'body': 'body'}))
+        self.assertIsNone(self.session.query(Post.last_edit).filter_by(post_id=1).scalar())
+
+    def test_missing(self):
+        self.assertIsNone(update_returning(self.session, Post, Post.post_id == 2, {'title': 'new'}))
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def test_invalidate_tag(self):
+        async def scenario():
+            cache = ResponseCache(LRUCache(10, 60))
+            await cache.set('post', json({'title': 'old'}), await cache.versions(['post:1']))
+            await cache.set('other', json({}), await cache.versions(['post:2']))
+            await cache.invalidate('post:1')
+            return await cache.get('post'), await cache.get('other')
+
+        post, other = asyncio.run(scenario())
+        self.assertIsNone(post)
+        self.assertIsNotNone(other)
+
+    def test_invalidate_from_other_worker(self):
+        async def scenario():
+            shared = LocalBackend()
+            first, second = ResponseCache(LRUCache(10, 60), shared), ResponseCache(LRUCache(10, 60), shared)
+            await first.set('post', json({'title': 'old'}), await first.versions(['post:1']))
+            await second.invalidate('post:1')
+            return await first.get('post')
+
+        self.assertIsNone(asyncio.run(scenario()))
+
+
+def send(path, headers=None, peer='10.0.0.1'):
+    """Проводит GET-запрос через приложение (middleware и обработчик) без запуска сервера и возвращает ответ"""
+    transport = SimpleNamespace(get_extra_info=lambda name: (peer, 50000) if name == 'peername' else None)
+    request = Request(path.encode(), Header(headers or {}), '1.1', 'GET', transport, app)
+    responses = []
+
+    async def stream(response):
+        responses.append(response)
+
+    asyncio.run(app.handle_request(request, responses.append, stream))
+    return responses[0]
+
+
+class AdmissionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limiter, admission.requests = admission.requests, RateLimiter(0.001, 2)
+
+    def tearDown(self):
+        admission.requests = self.limiter
+
+    def test_request_without_proxy_headers(self):
+        self.assertEqual(send('/trending').status, 200)
+
+    def test_forwarded_for_is_not_trusted(self):
+        statuses = [send('/trending', {'X-Forwarded-For': f'192.0.2.{index}'}).status for index in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_forwarded_for_behind_proxy(self):
+        with mock.patch.object(config, 'PROXIES_COUNT', 1):
+            statuses = [send('/trending', {'X-Forwarded-For': f'192.0.2.{index}'}).status for index in range(3)]
+        self.assertEqual(statuses, [200, 200, 200])
+
+
+class ConditionalTestCase(unittest.TestCase):
+    """Запросы проходят через приложение к SQLite в памяти: StaticPool отдаёт потокам пула одно соединение"""
+
+    def setUp(self):
+        engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        migrate(engine)
+        make_session.configure(bind=engine)
+        session = make_session()
+        session.add_all([Category(category_id=1, title='c', summary='s'),
+                         Post(post_id=1, category_id=1, title='p', body='b')])
+        session.commit()
+        session.close()
+        self.cache_enabled, config.CACHE_ENABLED = config.CACHE_ENABLED, False
+
+    def tearDown(self):
+        config.CACHE_ENABLED = self.cache_enabled
+
+    def test_any_etag_needs_existing_resource(self):
+        self.assertEqual(send('/get_post/1', {'If-None-Match': '*'}).status, 304)
+        self.assertEqual(send('/get_post/2', {'If-None-Match': '*'}).status, 400)
+        self.assertEqual(send('/get_comment/1', {'If-None-Match': '*'}).status, 400)
+        self.assertEqual(send('/get_posts/2?limit=5', {'If-None-Match': '*'}).status, 400)
+
+    def test_page_etag(self):
+        path = '/get_posts/1?limit=5&fields=post_id,comments_count'
+        etag = send(path).headers['ETag']
+        self.assertEqual(send(path, {'If-None-Match': etag}).status, 304)
+        session = make_session()
+        session.add(Comment(comment_id=1, post_id=1, title='t', body='b'))
+        session.commit()
+        session.close()
+        self.assertEqual(send(path, {'If-None-Match': etag}).status, 200)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,52 @@
+from sqlalchemy import literal
+from sqlalchemy.orm import aliased
+
+from app.models import Comment
+
+
+def thread_cte(session, root_condition, max_depth=None):
+    """
+    Строит рекурсивное табличное выражение (WITH RECURSIVE) с колонками comment_id и depth
+    для ветки комментариев.
+    :arg root_condition - условие отбора комментариев первого уровня,
+                          например Comment.parent_comment_id == 10
+    :arg max_depth - максимальная глубина ветки, 1 - только комментарии первого уровня (optional)
+    """
+    thread = session.query(Comment.comment_id, literal(1).label('depth')) \
+        .filter(root_condition) \
+        .cte('thread', recursive=True)
+
+    replies = aliased(Comment)
+    nested = session.query(replies.comment_id, thread.c.depth + 1) \
+        .filter(replies.parent_comment_id == thread.c.comment_id)
+    if max_depth is not None:
+        nested = nested.filter(thread.c.depth < max_depth)
+    return thread.union_all(nested)
+
+
+def load_thread(session, root_condition, max_depth=None, entities=None) -> list:
+    """
+    Выбирает ветку комментариев одним рекурсивным запросом (см. thread_cte).
+    :arg entities - что выбирать вместо Comment, например колонки комментария (optional)
+    :return список комментариев ветки, упорядоченный по (created, comment_id)
+    """
+    thread = thread_cte(session, root_condition, max_depth)
+    return session.query(*(entities or (Comment,))) \
+        .join(thread, Comment.comment_id == thread.c.comment_id) \
+        .order_by(Comment.created, Comment.comment_id) \
+        .all()
+
+
+def build_tree(comments, to_dict) -> list:
+    """
+    Собирает плоский список комментариев ветки во вложенное дерево.
+    Ответы на комментарий лежат в списке 'comments' его словаря.
+    :arg to_dict - функция, превращающая комментарий в словарь ответа
+    :return комментарии первого уровня ветки
+    """
+    nodes = {comment.comment_id: dict(to_dict(comment), comments=[]) for comment in comments}
+    roots = []
+    for comment in comments:
+        parent = nodes.get(comment.parent_comment_id)
+        (parent['comments'] if parent else roots).append(nodes[comment.comment_id])
+    return roots
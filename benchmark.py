@@ -0,0 +1,398 @@
+"""
+Нагрузочное тестирование SanicBoard.
+
+Usage:
+    python benchmark.py seed [--categories 20] [--posts 50] [--comments 30] [--depth 4]
+    python benchmark.py run [--url http://localhost:8000] [--concurrency 16] [--duration 30] [--output result.json]
+    python benchmark.py compare <old.json> <new.json>
+
+seed заполняет базу DATABASE_URI (см. config.py) синтетическим форумом: категории, посты в каждой категории
+и ветки комментариев заданной глубины. Для локального прогона без Postgres подходит SQLite:
+    DATABASE_URI=sqlite:///bench.db python manage.py migrate
+    DATABASE_URI=sqlite:///bench.db python benchmark.py seed
+    DATABASE_URI=sqlite:///bench.db WORKERS=1 python main.py
+
+run нагружает запущенный сервер смешанным потоком чтений и изменений по всем маршрутам app/routes.py
+с заданной конкурентностью и сохраняет p50/p95/p99, пропускную способность и количество SQL-запросов
+на запрос (по /metrics, точно при WORKERS=1) в JSON, чтобы сравнивать результаты разных коммитов через compare.
+"""
+import argparse
+import http.client
+import json
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+WORDS = ('sanic', 'board', 'python', 'postgres', 'async', 'cache', 'thread', 'index', 'query', 'worker',
+         'cursor', 'search', 'vector', 'commit', 'latency', 'forum', 'reply', 'release', 'bench', 'pool')
+
+
+def text(rand, words) -> str:
+    return ' '.join(rand.choice(WORDS) for _ in range(words))
+
+
+# -----------------------------------------------------S E E D----------------------------------------------------------
+def seed(categories=20, posts=50, comments=30, depth=4, random_seed=0):
+    """
+    Заполняет базу синтетическим форумом: categories категорий по posts постов,
+    в каждом посте comments комментариев, распределённых по depth уровням вложенности.
+    Строки вставляются многострочными INSERT через app.bulk.insert_many.
+    """
+    from main import create_db_engine, make_session
+    from app.bulk import insert_many
+    from app.db import session_scope
+    from app.models import Category, Post, Comment
+
+    rand = random.Random(random_seed)
+    make_session.configure(bind=create_db_engine())
+    with session_scope() as session:
+        category_ids = insert_many(session, Category, [
+            {'title': text(rand, 3), 'summary': text(rand, 12)} for _ in range(categories)])
+        post_ids = insert_many(session, Post, [
+            {'category_id': category_id, 'title': text(rand, 5), 'body': text(rand, 60)}
+            for category_id in category_ids for _ in range(posts)])
+
+        # комментарии вставляются по уровням: ответы каждого уровня ссылаются на комментарии предыдущего
+        per_level = [comments // depth + (level < comments % depth) for level in range(depth)]
+        parents = {post_id: [None] for post_id in post_ids}
+        for count in per_level:
+            rows = [{'post_id': post_id, 'parent_comment_id': rand.choice(parents[post_id]),
+                     'title': text(rand, 4), 'body': text(rand, 25)}
+                    for post_id in post_ids for _ in range(count)]
+            ids = insert_many(session, Comment, rows)
+            parents = defaultdict(list)
+            for row, comment_id in zip(rows, ids):
+                parents[row['post_id']].append(comment_id)
+    return {'categories': categories, 'posts': categories * posts, 'comments': categories * posts * comments,
+            'depth': depth}
+
+
+def dataset():
+    """Диапазоны идентификаторов в базе, из которых нагрузка выбирает читаемые записи"""
+    from sqlalchemy import func
+    from main import create_db_engine, make_session
+    from app.db import session_scope
+    from app.models import Category, Post, Comment
+
+    make_session.configure(bind=create_db_engine())
+    with session_scope() as session:
+        return {name: session.query(func.min(pk), func.max(pk)).one()
+                for name, pk in (('category_id', Category.category_id), ('post_id', Post.post_id),
+                                 ('comment_id', Comment.comment_id))}
+
+
+# -----------------------------------------------------W O R K L O A D--------------------------------------------------
+class Workload:
+    """
+    Смешанная нагрузка. Операции выбираются случайно с весами WEIGHTS; чтения обращаются к записям из seed,
+    изменения и удаления - к записям, созданным самой нагрузкой, чтобы не разрушать исходный набор данных.
+    """
+    WEIGHTS = {
+        'get_categories': 8, 'get_posts': 14, 'get_post': 14, 'get_comment': 10, 'get_post_thread': 8,
+        'get_comment_thread': 5, 'search_category': 3, 'search_post': 5, 'export': 1, 'trending': 3,
+        'add_category': 1, 'add_post': 3, 'add_comment': 8, 'add_categories': 1, 'add_posts': 1, 'add_comments': 1,
+        'edit_category': 1, 'edit_post': 3, 'edit_comment': 3,
+        'delete_category': 1, 'delete_post': 1, 'delete_comment': 2,
+        'cache_stats': 1,
+    }
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.created = {'category_id': [], 'post_id': [], 'comment_id': []}
+        self.lock = threading.Lock()
+
+    def existing(self, rand, name) -> int:
+        low, high = self.ids[name]
+        return rand.randint(low, high)
+
+    def remember(self, name, item_id):
+        with self.lock:
+            self.created[name].append(item_id)
+
+    def take(self, rand, name):
+        """Забирает созданную нагрузкой запись для удаления; None, если таких нет"""
+        with self.lock:
+            created = self.created[name]
+            return created.pop(rand.randrange(len(created))) if created else None
+
+    def pick(self, rand, name):
+        with self.lock:
+            created = self.created[name]
+            return rand.choice(created) if created else None
+
+    def request(self, rand):
+        """
+        Следующий запрос нагрузки.
+        :return (операция, метод, путь, тело, Content-Type, имя идентификатора созданной записи или None)
+        """
+        operation = rand.choices(list(self.WEIGHTS), weights=list(self.WEIGHTS.values()))[0]
+        limit = urlencode({'limit': rand.choice((10, 20, 50))})
+        form = 'application/x-www-form-urlencoded'
+
+        def new(words=8):
+            return urlencode({'title': text(rand, 3), 'body': text(rand, words), 'summary': text(rand, words)})
+
+        if operation == 'get_categories':
+            return operation, 'GET', f'/get_categories?{limit}', None, None, None
+        if operation == 'get_posts':
+            return operation, 'GET', f'/get_posts/{self.existing(rand, "category_id")}?{limit}', None, None, None
+        if operation == 'get_post':
+            return operation, 'GET', f'/get_post/{self.existing(rand, "post_id")}?{limit}', None, None, None
+        if operation == 'get_comment':
+            return operation, 'GET', f'/get_comment/{self.existing(rand, "comment_id")}', None, None, None
+        if operation == 'get_post_thread':
+            return operation, 'GET', f'/get_post_thread/{self.existing(rand, "post_id")}', None, None, None
+        if operation == 'get_comment_thread':
+            return operation, 'GET', f'/get_comment_thread/{self.existing(rand, "comment_id")}', None, None, None
+        if operation == 'search_category':
+            query = urlencode({'category_name': rand.choice(WORDS)[:4], 'limit': 20, 'offset': 0})
+            return operation, 'GET', f'/search_category?{query}', None, None, None
+        if operation == 'search_post':
+            query = urlencode({'post_name': f'{rand.choice(WORDS)} {rand.choice(WORDS)[:3]}', 'limit': 20,
+                               'offset': 0})
+            return operation, 'GET', f'/search_post?{query}', None, None, None
+        if operation == 'export':
+            query = urlencode({'category_id': self.existing(rand, 'category_id')})
+            return operation, 'GET', f'/export?{query}', None, None, None
+        if operation == 'trending':
+            query = urlencode({'category_id': self.existing(rand, 'category_id'), 'limit': 10})
+            return operation, 'GET', f'/trending?{query}', None, None, None
+        if operation == 'cache_stats':
+            return operation, 'GET', '/cache_stats', None, None, None
+
+        if operation == 'add_category':
+            return operation, 'POST', '/add_category', new(), form, 'category_id'
+        if operation == 'add_post':
+            return operation, 'POST', f'/add_post/{self.existing(rand, "category_id")}', new(40), form, 'post_id'
+        if operation == 'add_comment':
+            comment_id = self.pick(rand, 'comment_id')
+            if comment_id is None or rand.random() < 0.5:
+                return operation, 'POST', f'/add_comment/{self.existing(rand, "post_id")}', new(20), form, \
+                    'comment_id'
+            # ответ на созданный нагрузкой комментарий; пост берётся из ответа сервера при его создании
+            post_id, parent_comment_id = comment_id
+            body = new(20) + '&' + urlencode({'parent_comment_id': parent_comment_id})
+            return operation, 'POST', f'/add_comment/{post_id}', body, form, 'comment_id'
+        if operation == 'add_categories':
+            body = json.dumps([{'title': text(rand, 3), 'summary': text(rand, 10)} for _ in range(10)])
+            return operation, 'POST', '/add_categories', body, 'application/json', None
+        if operation == 'add_posts':
+            category_id = self.existing(rand, 'category_id')
+            body = json.dumps([{'category_id': category_id, 'title': text(rand, 4), 'body': text(rand, 40)}
+                               for _ in range(10)])
+            return operation, 'POST', '/add_posts', body, 'application/json', None
+        if operation == 'add_comments':
+            post_id = self.existing(rand, 'post_id')
+            body = json.dumps([{'post_id': post_id, 'title': text(rand, 4), 'body': text(rand, 20)}
+                               for _ in range(10)])
+            return operation, 'POST', '/add_comments', body, 'application/json', None
+
+        if operation.startswith('edit_'):
+            name = operation.replace('edit_', '') + '_id'
+            item_id = self.pick(rand, name)
+            if item_id is None:
+                return self.request(rand)
+            item_id = item_id[1] if name == 'comment_id' else item_id
+            return operation, 'POST', f'/{operation}/{item_id}', new(), form, None
+
+        name = operation.replace('delete_', '') + '_id'
+        item_id = self.take(rand, name)
+        if item_id is None:
+            return self.request(rand)
+        item_id = item_id[1] if name == 'comment_id' else item_id
+        return operation, 'DELETE', f'/{operation}/{item_id}', None, None, None
+
+
+def percentile(values, percent) -> float:
+    """Перцентиль методом ближайшего ранга; values должны быть отсортированы"""
+    if not values:
+        return 0.0
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+def summary(latencies, statuses, elapsed) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        'statuses': dict(statuses),
+    }
+
+
+def scrape_sql(address) -> dict:
+    """
+    Количество SQL-запросов и ответов по маршрутам из /metrics: {route: [запросов, ответов]}.
+    Соединение открывается заново: простаивающее keep-alive соединение сервер закрывает через KEEP_ALIVE_TIMEOUT.
+    """
+    connection = http.client.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+    try:
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        body = response.read().decode()
+    finally:
+        connection.close()
+    if response.status != 200:
+        return {}
+    totals = defaultdict(lambda: [0.0, 0])
+    for name, route, value in re.findall(
+            r'^sanicboard_request_sql_statements_(sum|count)\{route="([^"]*)",method="[^"]*"\} (\S+)$', body, re.M):
+        totals[route][0 if name == 'sum' else 1] += float(value)
+    return totals
+
+
+def route_label(path) -> str:
+    # та же группировка маршрутов, что и в app/metrics.py
+    return re.sub(r'/\d+', '/<id>', path.split('?')[0])
+
+
+def run(url='http://localhost:8000', concurrency=16, duration=30, warmup=5, random_seed=0):
+    """
+    Нагружает сервер url из concurrency потоков, каждый со своим keep-alive соединением.
+    Первые warmup секунд результаты не учитываются.
+    :return результаты прогона: сводка по всем запросам и по каждой операции
+    """
+    address = urlsplit(url)
+    workload = Workload(dataset())
+    latencies, statuses, routes = defaultdict(list), defaultdict(lambda: defaultdict(int)), {}
+    lock = threading.Lock()
+    started = time.perf_counter()
+    measured_from, deadline = started + warmup, started + warmup + duration
+
+    def worker(index):
+        rand = random.Random(random_seed * 1000 + index)
+        connection = http.client.HTTPConnection(address.hostname, address.port or 80, timeout=60)
+        while True:
+            operation, method, path, body, content_type, created = workload.request(rand)
+            headers = {'Content-Type': content_type} if content_type else {}
+            request_started = time.perf_counter()
+            if request_started >= deadline:
+                break
+            try:
+                connection.request(method, path, body=body and body.encode(), headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status, payload = 'error', b''
+            spent = time.perf_counter() - request_started
+
+            if created and status == 200:
+                result = json.loads(payload)
+                # для комментариев запоминается и пост, чтобы отвечать на них в том же посте
+                workload.remember(created, (result['post_id'], result[created]) if created == 'comment_id'
+                                  else result[created])
+            if request_started >= measured_from:
+                with lock:
+                    latencies[operation].append(spent)
+                    statuses[operation][str(status)] += 1
+                    routes[operation] = route_label(path)
+        connection.close()
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    time.sleep(max(0.0, measured_from - time.perf_counter()))
+    sql_before = scrape_sql(address)
+    for thread in threads:
+        thread.join()
+    sql_after = scrape_sql(address)
+
+    def queries_per_request(route_list):
+        statements = sum(sql_after.get(route, (0, 0))[0] - sql_before.get(route, (0, 0))[0] for route in route_list)
+        responses = sum(sql_after.get(route, (0, 0))[1] - sql_before.get(route, (0, 0))[1] for route in route_list)
+        return round(statements / responses, 2) if responses else None
+
+    all_statuses = defaultdict(int)
+    for counts in statuses.values():
+        for status, count in counts.items():
+            all_statuses[status] += count
+    return {
+        'total': dict(summary([spent for values in latencies.values() for spent in values], all_statuses, duration),
+                      queries_per_request=queries_per_request(set(routes.values()))),
+        'operations': {operation: dict(summary(latencies[operation], statuses[operation], duration),
+                                       route=routes[operation],
+                                       queries_per_request=queries_per_request([routes[operation]]))
+                       for operation in sorted(latencies)},
+    }
+
+
+def commit() -> str:
+    """Текущий коммит, чтобы результаты можно было сопоставить с версией кода"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -----------------------------------------------------C O M P A R E----------------------------------------------------
+def compare(old, new):
+    """Печатает изменение p50/p95/p99, пропускной способности и SQL-запросов на запрос между двумя прогонами"""
+    print(f'{"operation":<20}{"metric":<22}{old.get("commit") or "old":>12}{new.get("commit") or "new":>12}{"change":>10}')
+    rows = [('total', old['result']['total'], new['result']['total'])]
+    rows += [(operation, old['result']['operations'][operation], new['result']['operations'][operation])
+             for operation in sorted(new['result']['operations']) if operation in old['result']['operations']]
+    for operation, before, after in rows:
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput', 'queries_per_request'):
+            if before.get(metric) is None or after.get(metric) is None:
+                continue
+            change = f'{(after[metric] - before[metric]) / before[metric] * 100:+.1f}%' if before[metric] else ''
+            print(f'{operation:<20}{metric:<22}{before[metric]:>12}{after[metric]:>12}{change:>10}')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    seed_parser = commands.add_parser('seed')
+    seed_parser.add_argument('--categories', type=int, default=20)
+    seed_parser.add_argument('--posts', type=int, default=50, help='постов в каждой категории')
+    seed_parser.add_argument('--comments', type=int, default=30, help='комментариев в каждом посте')
+    seed_parser.add_argument('--depth', type=int, default=4, help='глубина веток комментариев')
+    seed_parser.add_argument('--random-seed', type=int, default=0)
+
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--url', default='http://localhost:8000')
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--duration', type=float, default=30, help='секунд измерения')
+    run_parser.add_argument('--warmup', type=float, default=5, help='секунд прогрева без измерения')
+    run_parser.add_argument('--random-seed', type=int, default=0)
+    run_parser.add_argument('--output', help='файл для результатов в JSON')
+
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if args.command == 'seed':
+        print(json.dumps(seed(args.categories, args.posts, args.comments, args.depth, args.random_seed)))
+    elif args.command == 'run':
+        report = {'commit': commit(), 'started': datetime.utcnow().isoformat(),
+                  'settings': {'url': args.url, 'concurrency': args.concurrency, 'duration': args.duration,
+                               'warmup': args.warmup, 'random_seed': args.random_seed},
+                  'result': run(args.url, args.concurrency, args.duration, args.warmup, args.random_seed)}
+        print(json.dumps(report['result']['total'], indent=2))
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(report, output, indent=2)
+    elif args.command == 'compare':
+        with open(args.old) as old, open(args.new) as new:
+            compare(json.load(old), json.load(new))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,17 +1,42 @@
 from sanic import Sanic
 import config
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
-from app.models import Base
 
-db = create_engine(config.DATABASE_URI)
-Base.metadata.create_all(db)
-make_session = sessionmaker(bind=db)
+# Движок и пул соединений создаются при старте каждого воркера (connect_db), уже после fork,
+# чтобы процессы не делили между собой соединения. Схема базы создаётся отдельно: python manage.py migrate
+make_session = sessionmaker()
 
 app = Sanic()
 
+
+def create_db_engine(uri=config.DATABASE_URI):
+    """Создаёт движок с пулом соединений, настроенным по config.py. Для СУБД, кроме Postgres, пул не настраивается."""
+    if not make_url(uri).get_backend_name().startswith('postgres'):
+        return create_engine(uri)
+
+    connect_args = {}
+    if config.DB_STATEMENT_TIMEOUT:
+        connect_args['options'] = f'-c statement_timeout={config.DB_STATEMENT_TIMEOUT}'
+    # соединения выгрузок (app/db.py, stream_in_db) открываются сверх соединений потоков db_executor
+    return create_engine(uri, pool_size=config.DB_POOL_SIZE,
+                         max_overflow=config.DB_MAX_OVERFLOW + config.EXPORT_CONCURRENCY,
+                         pool_recycle=config.DB_POOL_RECYCLE, connect_args=connect_args)
+
+
+@app.listener('before_server_start')
+async def connect_db(app, loop):
+    make_session.configure(bind=create_db_engine())
+
+
+@app.listener('after_server_stop')
+async def disconnect_db(app, loop):
+    make_session.kw['bind'].dispose()
+
+
 from app.routes import *
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000)
+    app.run(host=config.HOST, port=config.PORT, workers=config.WORKERS)
@@ -0,0 +1,41 @@
+"""
+Служебные команды, выполняемые отдельно от запуска сервера.
+
+Usage: python manage.py migrate | check_queries
+
+migrate - применяет недостающие миграции схемы (app/migrations.py); create_schema - прежнее имя команды
+check_queries - строит планы запросов маршрутов и сообщает о полных просмотрах таблиц (код выхода 1)
+"""
+import sys
+
+from main import create_db_engine
+from app.migrations import migrate as migrate_schema
+from app.plans import check_plans
+
+
+def migrate():
+    """Применяет недостающие миграции: создаёт таблицы и индексы"""
+    applied = migrate_schema(create_db_engine())
+    for version, description in applied:
+        print(f'Applied migration {version}: {description}')
+    if not applied:
+        print('Schema is up to date')
+
+
+def check_queries():
+    """Проверяет, что запросы маршрутов выполняются по индексам"""
+    problems = check_plans(create_db_engine())
+    for route, table, statement in problems:
+        print(f'{route}: full scan of {table}\n    {" ".join(statement.split())}')
+    if problems:
+        sys.exit(1)
+    print('All route queries use indexes')
+
+
+COMMANDS = {'migrate': migrate, 'create_schema': migrate, 'check_queries': check_queries}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        sys.exit(__doc__)
+    COMMANDS[sys.argv[1]]()
@@ -0,0 +1,20 @@
+#!/bin/bash
+# Copies the primary with pg_basebackup on the first start and runs it as a hot standby.
+set -e
+
+DATA=/var/lib/postgresql/replica
+
+if [ ! -s "$DATA/PG_VERSION" ]; then
+    until PGPASSWORD=docker pg_basebackup -h postgres -U docker -D "$DATA" -R -X stream; do
+        echo "Waiting for the primary..."
+        rm -rf "$DATA"
+        sleep 2
+    done
+    # the primary keeps its configuration in /etc/postgresql, so the backup has none
+    echo "listen_addresses='*'" > "$DATA/postgresql.conf"
+    echo "hot_standby=on" >> "$DATA/postgresql.conf"
+    printf 'local all all trust\nhost all all 0.0.0.0/0 md5\n' > "$DATA/pg_hba.conf"
+    chmod 700 "$DATA"
+fi
+
+exec /usr/lib/postgresql/12/bin/postgres -D "$DATA"